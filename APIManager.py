@@ -1,14 +1,77 @@
+import time
+import json
+import hashlib
+import threading
+import collections
+import concurrent.futures
 from google import genai
+from google.genai import types, errors
 from project_logger import setup_project_logger
-from config import API_KEY, EXTERNAL_MODEL # Import API_KEY and EXTERNAL_MODEL from config
-from tenacity import retry, wait_exponential, stop_after_attempt, RetryError
+from config import get_api_key, EXTERNAL_MODEL # Import get_api_key and EXTERNAL_MODEL from config
+from config import CONTEXT_CACHING, CONTEXT_CACHE_TTL_SECONDS, CONTEXT_CACHE_RETRY_SECONDS, MAX_WORKERS, LLM_METRICS_FILE
+from config import (
+    LLM_CALL_TIMEOUT_SECONDS, HEDGE_REQUESTS, HEDGE_LATENCY_PERCENTILE, HEDGE_MIN_SAMPLES,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+from CircuitBreaker import CircuitBreaker
+from StreamParser import StreamParser
+from tenacity import retry, retry_if_exception, wait_exponential, stop_after_attempt, RetryError
+
+class NonRetryableError(RetryError):
+    """Raised for requests the API rejected, which would fail the same way if retried."""
+
+class RateLimiterError(RetryError):
+    """Raised when the rate limiter failed, so the request was never sent to the API."""
+
+# Rate limited calls back off for longer than transient server or network failures
+_rate_limited_wait = wait_exponential(multiplier=1, min=4, max=60) # Wait 2^x * multiplier seconds between retries, max 60s
+_transient_wait = wait_exponential(multiplier=0.5, min=1, max=10)
+
+def _is_rate_limited(e: BaseException):
+    cause = e.__cause__ or e
+    return isinstance(cause, errors.ClientError) and cause.code == 429
+
+def _is_upstream_failure(e: BaseException):
+    """Server errors, rate limiting, timeouts and network errors count towards the circuit breaker."""
+    if isinstance(e, errors.ClientError):
+        return e.code == 429
+    return not isinstance(e, RetryError)
+
+def _is_missing_cache(e: BaseException):
+    """Whether a request failed because its cached content expired or was deleted."""
+    return isinstance(e, errors.ClientError) and (
+        e.code == 404 or (e.code in (400, 403) and "cache" in str(e).lower()))
+
+def _is_retryable(e: BaseException):
+    return not isinstance(e, NonRetryableError)
+
+def _retry_wait(retry_state):
+    if _is_rate_limited(retry_state.outcome.exception()):
+        return _rate_limited_wait(retry_state)
+    return _transient_wait(retry_state)
 
 class APIManager:
     logger = setup_project_logger("APIManager")
 
     def __init__(self):
-        self.api_key = API_KEY
+        self.api_key = get_api_key()
         self.model_name = EXTERNAL_MODEL
+        self.context_caching = CONTEXT_CACHING
+        # Maps the hash of a prompt prefix to (cache name, expiry time). A cache name of None
+        # marks a prefix the backend refused to cache, so it is sent inline from then on.
+        self._context_caches = {}
+        self._context_cache_lock = threading.Lock()
+        # Registration holds a lock per prefix, so a slow backend call only delays callers of that prefix
+        self._context_cache_key_locks = {}
+        # Optional callable that blocks until a request may be sent, e.g. a shared rate budget
+        self.rate_limiter = None
+        self.hedge_requests = HEDGE_REQUESTS
+        self._latencies = collections.deque(maxlen=500)
+        self._latency_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        # Room for a hedged duplicate of every request the worker pool can have in flight
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS * 2)
+        # Shared by all worker threads, so they pause together during an upstream outage
+        self.circuit_breaker = CircuitBreaker("GenAI", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
         if not self.api_key:
             self.logger.error("API_KEY not found in environment variables. Please set it in your .env file.")
             raise ValueError("API_KEY is not set.")
@@ -19,31 +82,274 @@ class APIManager:
             self.logger.critical(f"Failed to initialize GenAI model '{self.model_name}': {e}")
             raise
 
+    def _get_context_cache(self, prefix: str):
+        """
+        Returns the name of the cached context holding the given prompt prefix, registering
+        it with the backend on first use. Returns None if the backend cannot cache it; prefixes
+        it rejects (e.g. below the minimum size) are sent inline from then on, and after other
+        failures registration is retried once CONTEXT_CACHE_RETRY_SECONDS have passed.
+        """
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        with self._context_cache_lock:
+            entry = self._context_caches.get(key)
+            if entry is not None and time.time() < entry[1]:
+                return entry[0]
+            key_lock = self._context_cache_key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another caller may have registered the prefix while this one waited
+            with self._context_cache_lock:
+                entry = self._context_caches.get(key)
+            if entry is not None:
+                cache_name, expires_at = entry
+                if time.time() < expires_at:
+                    return cache_name
+                if cache_name is not None:
+                    # The expiring cache is replaced below rather than left to its TTL
+                    self._delete_context_cache(cache_name)
+
+            try:
+                cache = self.client.caches.create(
+                    model=self.model_name,
+                    config=types.CreateCachedContentConfig(
+                        contents=[prefix],
+                        ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s",
+                        http_options=types.HttpOptions(timeout=LLM_CALL_TIMEOUT_SECONDS * 1000),
+                    ),
+                )
+                # Refresh slightly before the backend expires the cache
+                entry = (cache.name, time.time() + CONTEXT_CACHE_TTL_SECONDS * 0.9)
+                self.logger.info(f"Registered cached context '{cache.name}' for prompt prefix {key[:12]}.")
+            except Exception as e:
+                if isinstance(e, errors.ClientError) and e.code == 400:
+                    self.logger.warning(f"Context caching not available for prompt prefix {key[:12]}, sending it inline: {e}")
+                    entry = (None, float("inf"))
+                else:
+                    self.logger.warning(f"Failed to register cached context for prompt prefix {key[:12]}, "
+                                        f"sending it inline for {CONTEXT_CACHE_RETRY_SECONDS}s: {e}")
+                    entry = (None, time.time() + CONTEXT_CACHE_RETRY_SECONDS)
+            with self._context_cache_lock:
+                self._context_caches[key] = entry
+            return entry[0]
+
+    def _delete_context_cache(self, cache_name: str):
+        try:
+            self.client.caches.delete(
+                name=cache_name,
+                config=types.DeleteCachedContentConfig(
+                    http_options=types.HttpOptions(timeout=LLM_CALL_TIMEOUT_SECONDS * 1000)))
+            self.logger.info(f"Deleted cached context '{cache_name}'.")
+        except Exception as e:
+            # It expires with its TTL anyway
+            self.logger.warning(f"Failed to delete cached context '{cache_name}': {e}")
+
+    def _invalidate_context_cache(self, prefix: str):
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        with self._context_cache_lock:
+            entry = self._context_caches.get(key)
+            if entry is not None and entry[0] is not None:
+                del self._context_caches[key]
+
+    def _prepare_request(self, prompt_content: str, cached_prefix: str | None, response_schema: dict | None = None):
+        """
+        Returns (contents, config, cache_name) for a request. If cached_prefix is given and
+        prompt_content starts with it, the prefix is sent as cached context and only the
+        remainder of the prompt is sent with the request. If response_schema is given the
+        response is constrained to JSON matching it.
+        """
+        contents, config_args, cache_name = prompt_content, {}, None
+        if self.context_caching and cached_prefix and prompt_content.startswith(cached_prefix):
+            cache_name = self._get_context_cache(cached_prefix)
+            if cache_name:
+                config_args["cached_content"] = cache_name
+                contents = prompt_content[len(cached_prefix):]
+        if response_schema:
+            config_args["response_mime_type"] = "application/json"
+            config_args["response_schema"] = response_schema
+        # Per-call deadline, so a hung request cannot hold a worker indefinitely
+        config_args["http_options"] = types.HttpOptions(timeout=LLM_CALL_TIMEOUT_SECONDS * 1000)
+        config = types.GenerateContentConfig(**config_args)
+        return contents, config, cache_name
+
+    def _record_latency(self, seconds: float):
+        with self._latency_lock:
+            self._latencies.append(seconds)
+
+    def _record_call_metrics(self, latency: float, response):
+        """Appends the latency and token usage of a call to LLM_METRICS_FILE, used by RunPlanner."""
+        usage = getattr(response, "usage_metadata", None)
+        metrics = {
+            "time": time.time(),
+            "model": self.model_name,
+            "latency": round(latency, 3),
+            "prompt_tokens": getattr(usage, "prompt_token_count", None),
+            "cached_tokens": getattr(usage, "cached_content_token_count", None),
+            "output_tokens": getattr(usage, "candidates_token_count", None),
+            "output_chars": len(response.text or ""),
+        }
+        try:
+            with self._metrics_lock:
+                LLM_METRICS_FILE.parent.mkdir(parents=True, exist_ok=True)
+                with open(LLM_METRICS_FILE, 'a') as file:
+                    file.write(json.dumps(metrics) + "\n")
+        except Exception as e:
+            self.logger.warning(f"Failed to record call metrics: {e}")
+
+    def _hedge_delay(self):
+        """Returns the latency after which a call is hedged, or None until enough calls were seen."""
+        if not self.hedge_requests:
+            return None
+        with self._latency_lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(HEDGE_LATENCY_PERCENTILE * (len(latencies) - 1))]
+
+    def _wait_for_rate_limit(self):
+        if not self.rate_limiter:
+            return
+        try:
+            self.rate_limiter()
+        except Exception as e:
+            raise RateLimiterError(f"Rate limiter failed: {e}") from e
+
+    def _generate(self, contents, config):
+        self._wait_for_rate_limit()
+        start_time = time.monotonic()
+        # response = self.client.generate_content(
+        #     contents=prompt_content,
+        # )
+        response = self.client.models.generate_content(
+        model=self.model_name,
+        contents=contents,
+        config=config,
+        )
+        latency = time.monotonic() - start_time
+        self._record_latency(latency)
+        if response and response.text:
+            self._record_call_metrics(latency, response)
+            return response.text
+        self.logger.warning("GenAI API call returned no text content.")
+        raise RetryError("No text content in GenAI response, retrying...")
+
+    def _generate_with_hedging(self, contents, config):
+        """
+        Sends the request and, if it is still running after the hedge delay, a duplicate of it.
+        The first successful response wins. Raises TimeoutError once the call deadline passes.
+        """
+        deadline = time.monotonic() + LLM_CALL_TIMEOUT_SECONDS
+        futures = [self._executor.submit(self._generate, contents, config)]
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is not None:
+            done, _ = concurrent.futures.wait(futures, timeout=hedge_delay)
+            if not done:
+                self.logger.info(f"Call still running after {hedge_delay:.1f}s, sending hedged request.")
+                futures.append(self._executor.submit(self._generate, contents, config))
+
+        pending = set(futures)
+        last_error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = concurrent.futures.wait(pending, timeout=remaining,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                last_error = future.exception()
+        if last_error is not None and not pending:
+            raise last_error
+        raise TimeoutError(f"No response from GenAI API within {LLM_CALL_TIMEOUT_SECONDS}s.")
+
+    def _handle_call_error(self, e: Exception, cache_name: str | None, cached_prefix: str | None):
+        """Feeds the circuit breaker and returns the exception to raise for a failed call."""
+        if isinstance(e, RateLimiterError):
+            # Nothing reached the backend, so the circuit state is left as it is
+            self.circuit_breaker.release_probe()
+            return e
+        if _is_upstream_failure(e):
+            self.circuit_breaker.record_failure()
+        else:
+            # The backend answered, so it is reachable
+            self.circuit_breaker.record_success()
+
+        if cache_name and _is_missing_cache(e):
+            # The cache expired or was evicted; register it again on retry
+            self._invalidate_context_cache(cached_prefix)
+            return RetryError(f"GenAI API call failed: {e}")
+        if isinstance(e, errors.ClientError) and e.code != 429:
+            return NonRetryableError(f"GenAI API rejected the request: {e}")
+        return RetryError(f"GenAI API call failed: {e}")
+
     @retry(
-        wait=wait_exponential(multiplier=1, min=4, max=60), # Wait 2^x * multiplier seconds between retries, max 60s
+        retry=retry_if_exception(_is_retryable),
+        wait=_retry_wait,
         stop=stop_after_attempt(5), # Stop after 5 attempts
         reraise=True # Re-raise the last exception if all retries fail
     )
-    def call_llm_api(self, prompt_content: str):
+    def call_llm_api(self, prompt_content: str, cached_prefix: str | None = None, response_schema: dict | None = None):
         """
         Internal method to make a single LLM API call with retry logic.
         This method is decorated with tenacity for automatic retries.
+        Requests that are rejected by the API (4xx other than 429) are not retried.
         """
         self.logger.info(f"Attempting to call GenAI with model: {self.model_name}")
+        contents, config, cache_name = self._prepare_request(prompt_content, cached_prefix, response_schema)
+        self.circuit_breaker.before_call()
+
         try:
-            # response = self.client.generate_content(
-            #     contents=prompt_content,
-            # )
-            response = self.client.models.generate_content(
-            model=self.model_name,
-            contents=prompt_content,
-            )
+            text = self._generate_with_hedging(contents, config)
+            self.circuit_breaker.record_success()
             self.logger.info("Successfully received response from GenAI API.")
-            if response and response.text:
-                return response.text
-            else:
-                self.logger.warning("GenAI API call returned no text content.")
-                raise RetryError("No text content in GenAI response, retrying...")
+            return text
         except Exception as e:
             self.logger.error(f"Error calling GenAI API: {e}", exc_info=True)
-            raise RetryError(f"GenAI API call failed: {e}") from e
+            raise self._handle_call_error(e, cache_name, cached_prefix) from e
+
+    @retry(
+        retry=retry_if_exception(_is_retryable),
+        wait=_retry_wait,
+        stop=stop_after_attempt(5),
+        reraise=True
+    )
+    def call_llm_api_stream(self, prompt_content: str, section: str, cached_prefix: str | None = None):
+        """
+        Streamed variant of call_llm_api. Chunks are parsed as they arrive and the request is
+        cancelled as soon as the output clearly fails the format expected for the section.
+
+        Returns:
+            StreamParser: The parser holding the full response text and the parsed section lines.
+        """
+        self.logger.info(f"Attempting to stream GenAI response with model: {self.model_name}")
+        contents, config, cache_name = self._prepare_request(prompt_content, cached_prefix)
+        parser = StreamParser(section)
+        # Waiting for the rate limit first keeps a half-open probe from being held while blocked
+        self._wait_for_rate_limit()
+        self.circuit_breaker.before_call()
+
+        try:
+            stream = self.client.models.generate_content_stream(
+            model=self.model_name,
+            contents=contents,
+            config=config,
+            )
+            try:
+                for chunk in stream:
+                    if chunk.text and not parser.feed(chunk.text):
+                        self.logger.warning(f"Streamed response does not match the {section} format after "
+                                            f"{parser.lines_seen} lines, cancelling request.")
+                        raise RetryError(f"Malformed {section} response, retrying...")
+            finally:
+                # Closing the generator drops the underlying HTTP stream
+                stream.close()
+
+            if not parser.close():
+                self.logger.warning(f"Streamed response contains no {section} lines.")
+                raise RetryError(f"No {section} content in GenAI response, retrying...")
+            self.circuit_breaker.record_success()
+            self.logger.info("Successfully received streamed response from GenAI API.")
+            return parser
+        except Exception as e:
+            self.logger.error(f"Error streaming GenAI API response: {e}", exc_info=True)
+            raise self._handle_call_error(e, cache_name, cached_prefix) from e
@@ -0,0 +1,91 @@
+from project_logger import setup_project_logger
+
+# Collection methods rendered by each formatter, including mongo shell spellings
+OPERATION_ALIASES = {
+    "count": "count", "count_documents": "count", "countDocuments": "count",
+    "estimated_document_count": "count", "estimatedDocumentCount": "count",
+    "find": "find", "find_one": "find", "findOne": "find",
+    "aggregate": "aggregate",
+    "distinct": "distinct",
+}
+
+class AnswerFormatter:
+    """
+    Renders the result of an executed query into answer text. Formatters are looked up by
+    operation (count, find, aggregate, distinct) and can be replaced with register().
+    """
+    logger = setup_project_logger("AnswerFormatter")
+
+    def __init__(self, formatters: dict | None = None):
+        self.formatters = {
+            "count": self._format_count,
+            "find": self._format_documents,
+            "aggregate": self._format_aggregate,
+            "distinct": self._format_values,
+        }
+        self.formatters.update(formatters or {})
+
+    def register(self, operation: str, formatter):
+        """Sets the formatter for an operation. It is called with (result, truncated) and returns a str."""
+        self.formatters[operation] = formatter
+
+    def _format_value(self, value):
+        if isinstance(value, dict):
+            return "{" + ", ".join(f"{key}: {self._format_value(item)}" for key, item in value.items()) + "}"
+        if isinstance(value, list):
+            return "[" + ", ".join(self._format_value(item) for item in value) + "]"
+        return str(value)
+
+    def _format_count(self, result, truncated):
+        return str(result)
+
+    def _format_values(self, result, truncated):
+        if not result:
+            return "No matching values found."
+        text = ", ".join(self._format_value(value) for value in result)
+        return f"{text} (first {len(result)} values)" if truncated else text
+
+    def _format_fields(self, fields: dict):
+        if len(fields) == 1:
+            return self._format_value(next(iter(fields.values())))
+        return ", ".join(f"{key}: {self._format_value(value)}" for key, value in fields.items())
+
+    def _format_documents(self, result, truncated, group_keys=False):
+        if result is None or result == []:
+            return "No matching records found."
+        documents = [result] if isinstance(result, dict) else result
+
+        rendered = []
+        for document in documents:
+            fields = {key: value for key, value in document.items() if key != "_id"} or document
+            group_key = document.get("_id")
+            # In $group output _id is the group key; generated ids and the null key of a total carry no answer
+            if group_keys and fields is not document and group_key is not None and type(group_key).__name__ != "ObjectId":
+                rendered.append(f"{self._format_value(group_key)}: {self._format_fields(fields)}")
+            else:
+                rendered.append(self._format_fields(fields))
+        text = "; ".join(rendered)
+        return f"{text} (first {len(documents)} records)" if truncated else text
+
+    def _format_aggregate(self, result, truncated):
+        return self._format_documents(result, truncated, group_keys=True)
+
+    def format(self, query_result: dict):
+        """
+        Renders a query result from DBManager.run_query.
+
+        Returns:
+            str | None: The answer text on a single line, or None if there is no formatter for the operation.
+        """
+        operation = OPERATION_ALIASES.get(query_result["operation"], query_result["operation"])
+        formatter = self.formatters.get(operation)
+        if formatter is None:
+            self.logger.warning(f"No answer formatter for operation '{query_result['operation']}'.")
+            return None
+        result = query_result["result"]
+        if result is not None and not isinstance(result, (list, dict)):
+            # Scalars, e.g. counts, render the same whichever operation produced them
+            text = self._format_value(result)
+        else:
+            text = formatter(result, query_result["truncated"])
+        return " ".join(str(text).split())
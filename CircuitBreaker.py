@@ -0,0 +1,68 @@
+import time
+import threading
+from project_logger import setup_project_logger
+
+class CircuitBreaker:
+    """
+    Shared circuit breaker for upstream calls. After failure_threshold consecutive upstream
+    failures the circuit opens and every caller is paused in before_call until
+    reset_timeout_seconds have passed. A single probe call is then let through; its success
+    closes the circuit, its failure opens it again.
+    """
+    logger = setup_project_logger("CircuitBreaker")
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._condition = threading.Condition()
+
+    def before_call(self):
+        """Blocks while the circuit is open."""
+        with self._condition:
+            while True:
+                if self.state == "closed":
+                    return
+                if self.state == "open":
+                    remaining = self._opened_at + self.reset_timeout_seconds - time.monotonic()
+                    if remaining > 0:
+                        self._condition.wait(remaining)
+                        continue
+                    self.state = "half_open"
+                    self._probe_in_flight = False
+                    self.logger.info(f"Circuit '{self.name}' half-open, sending a probe call.")
+                if not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    return
+                self._condition.wait()
+
+    def record_success(self):
+        with self._condition:
+            if self.state != "closed":
+                self.logger.info(f"Circuit '{self.name}' closed, resuming calls.")
+            self.state = "closed"
+            self.failures = 0
+            self._probe_in_flight = False
+            self._condition.notify_all()
+
+    def release_probe(self):
+        """Lets another caller probe when the call let through was never sent upstream."""
+        with self._condition:
+            if self._probe_in_flight:
+                self._probe_in_flight = False
+                self._condition.notify_all()
+
+    def record_failure(self):
+        with self._condition:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.logger.warning(f"Circuit '{self.name}' opened after {self.failures} consecutive failures, "
+                                    f"pausing calls for {self.reset_timeout_seconds}s.")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+                self._condition.notify_all()
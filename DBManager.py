@@ -1,39 +1,164 @@
-import ast
+import itertools
 import textwrap
+import time
+from datetime import datetime, timedelta, timezone
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from config import DATABASE, HOST, PORT
+from config import (
+    JOB_QUEUE_DATABASE, JOB_QUEUE_COLLECTION, RATE_BUDGET_COLLECTION,
+    JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS)
 from project_logger import setup_project_logger
+from QueryCompiler import QueryCompiler, QueryCompileError
 
 
 class DBManager:
     logger = setup_project_logger("DBManager")
 
-    def __init__(self):
+    def __init__(self, database: str = DATABASE):
         self.client = None
         self.db = None
+        self.query_compiler = QueryCompiler()
         try:
             self.client = MongoClient(HOST, PORT, serverSelectionTimeoutMS=1000)
-            self.db = self.client[DATABASE]
+            self.db = self.client[database]
             self.client.admin.command('ping')
             self.logger.info("Connected to MongoDB.")
         except Exception as e:
             self.logger.error(f"Could not connect to MongoDB: {e}")
 
+    def use_database(self, database: str):
+        """Points validation at another database on the same server, e.g. a sampled sandbox."""
+        self.db = self.client[database]
+        self.logger.info(f"Queries now run against database '{database}'.")
+
+    @property
+    def jobs(self):
+        return self.client[JOB_QUEUE_DATABASE][JOB_QUEUE_COLLECTION]
+
+    @property
+    def rate_budget(self):
+        return self.client[JOB_QUEUE_DATABASE][RATE_BUDGET_COLLECTION]
+
+    def ensure_job_queue_indexes(self):
+        self.jobs.create_index([("run_id", pymongo.ASCENDING), ("status", pymongo.ASCENDING), ("lease_expires_at", pymongo.ASCENDING)])
+        # Rate budget windows are removed by MongoDB once they are over
+        self.rate_budget.create_index("expires_at", expireAfterSeconds=0)
+
+    def enqueue_jobs(self, run_id: str, jobs: list):
+        """
+        Adds jobs to the queue for a run. Each job is a dict with a unique "job_id"; jobs that
+        are already queued for the run are left untouched, so enqueuing is idempotent.
+
+        Returns:
+            int: The number of newly queued jobs.
+        """
+        self.ensure_job_queue_indexes()
+        now = datetime.now(timezone.utc)
+        operations = []
+        for job in jobs:
+            operations.append(pymongo.UpdateOne(
+                {"_id": f"{run_id}:{job['job_id']}"},
+                {"$setOnInsert": {"run_id": run_id, "payload": job["payload"], "status": "pending",
+                                  "attempts": 0, "worker_id": None, "lease_expires_at": None,
+                                  "result": None, "enqueued_at": now}},
+                upsert=True))
+        if not operations:
+            return 0
+        result = self.jobs.bulk_write(operations, ordered=False)
+        self.logger.info(f"Queued {result.upserted_count} new jobs for run {run_id}.")
+        return result.upserted_count
+
+    def claim_job(self, run_id: str, worker_id: str, lease_seconds: int = JOB_LEASE_SECONDS):
+        """
+        Atomically leases the oldest pending job of a run to a worker. Jobs whose lease has
+        expired (their worker died or stalled) are reclaimed the same way.
+
+        Returns:
+            dict | None: The claimed job document, or None if there is nothing to do.
+        """
+        now = datetime.now(timezone.utc)
+        return self.jobs.find_one_and_update(
+            {"run_id": run_id, "attempts": {"$lt": JOB_MAX_ATTEMPTS},
+             "$or": [{"status": "pending"},
+                     {"status": "leased", "lease_expires_at": {"$lt": now}}]},
+            {"$set": {"status": "leased", "worker_id": worker_id,
+                      "lease_expires_at": now + timedelta(seconds=lease_seconds)},
+             "$inc": {"attempts": 1}},
+            sort=[("enqueued_at", pymongo.ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def extend_lease(self, job_id: str, worker_id: str, lease_seconds: int = JOB_LEASE_SECONDS):
+        """Heartbeat for a leased job. Returns False if the worker no longer holds the lease."""
+        result = self.jobs.update_one(
+            {"_id": job_id, "worker_id": worker_id, "status": "leased"},
+            {"$set": {"lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)}})
+        return result.matched_count == 1
+
+    def complete_job(self, job_id: str, worker_id: str, result):
+        """Stores the result of a leased job. Returns False if the worker lost the lease."""
+        update = self.jobs.update_one(
+            {"_id": job_id, "worker_id": worker_id, "status": "leased"},
+            {"$set": {"status": "done", "result": result, "lease_expires_at": None,
+                      "completed_at": datetime.now(timezone.utc)}})
+        return update.matched_count == 1
+
+    def release_job(self, job_id: str, worker_id: str, error: str):
+        """Returns a failed job to the queue, or marks it failed once it is out of attempts."""
+        job = self.jobs.find_one({"_id": job_id, "worker_id": worker_id, "status": "leased"})
+        if job is None:
+            return False
+        status = "failed" if job["attempts"] >= JOB_MAX_ATTEMPTS else "pending"
+        self.jobs.update_one(
+            {"_id": job_id, "worker_id": worker_id, "status": "leased"},
+            {"$set": {"status": status, "worker_id": None, "lease_expires_at": None, "error": error}})
+        return True
+
+    def job_status_counts(self, run_id: str):
+        # Expired leases on jobs that are out of attempts can never be reclaimed
+        self.jobs.update_many(
+            {"run_id": run_id, "status": "leased", "attempts": {"$gte": JOB_MAX_ATTEMPTS},
+             "lease_expires_at": {"$lt": datetime.now(timezone.utc)}},
+            {"$set": {"status": "failed", "worker_id": None, "error": "Lease expired on the last attempt."}})
+        counts = self.jobs.aggregate([{"$match": {"run_id": run_id}},
+                                      {"$group": {"_id": "$status", "count": {"$sum": 1}}}])
+        return {item["_id"]: item["count"] for item in counts}
+
+    def finished_jobs(self, run_id: str):
+        return self.jobs.find({"run_id": run_id, "status": "done"})
+
+    def acquire_rate_slot(self, requests_per_minute: int):
+        """
+        Takes one request from the per-minute budget shared by every worker node.
+
+        Returns:
+            float: 0 if a slot was taken, otherwise the seconds until the next window opens.
+        """
+        now = time.time()
+        window = int(now // 60)
+        slot_filter = {"_id": window, "count": {"$lt": requests_per_minute}}
+        try:
+            # The filter only matches while the window has budget left; once it is exhausted
+            # the upsert collides with the existing window document.
+            self.rate_budget.find_one_and_update(
+                slot_filter,
+                {"$inc": {"count": 1},
+                 "$setOnInsert": {"expires_at": datetime.fromtimestamp((window + 2) * 60, timezone.utc)}},
+                upsert=True)
+            return 0
+        except DuplicateKeyError:
+            # The collision is also raised when another node created the window first, so
+            # the slot is taken without the upsert before treating the budget as exhausted.
+            if self.rate_budget.find_one_and_update(slot_filter, {"$inc": {"count": 1}}) is not None:
+                return 0
+            return (window + 1) * 60 - now
+
     def check_collections_in_db(self):
         if self.db is not None:
             return self.db.list_collection_names()
         return []
 
-    def _is_valid_syntax(self, code_str):
-        """Check if code has valid Python syntax (e.g., matching brackets)"""
-        try:
-            ast.parse(code_str)
-            return True
-        except SyntaxError as e:
-            self.logger.error(f"Syntax error in query: {e}")
-            return False
-
     def auto_fix_brackets(self, code_str):
         """Fix unbalanced (, {, [ brackets by appending the required closing brackets."""
         bracket_pairs = {'(': ')', '{': '}', '[': ']'}
@@ -52,62 +177,83 @@ class DBManager:
         return code_str + ''.join(reversed(stack))
 
 
-    def _wrap_if_not_lambda(self, query_str):
-        """If not a lambda, try to wrap the raw query (e.g., db.COLLECTION.find(...)) into lambda db: ..."""
-        if "lambda db" in query_str:
-            return query_str  # Already correct
-
-        try:
-            stripped = query_str.strip()
-            if not stripped.startswith("db."):
-                raise ValueError("Query must start with 'db.'")
-
-            parts = stripped.split(".")
-            if len(parts) < 3:
-                raise ValueError("Query must follow format: db.Collection.operation(...)")
-
-            collection = parts[1]
-            operation = ".".join(parts[2:])  # Everything after collection name
-            return f'lambda db: db["{collection}"].{operation}'
-        except Exception as e:
-            self.logger.error(f"Cannot wrap query into lambda: {e}")
-            return None
-
     def validate_query(self, query_str, attempt_fix=True):
         """
         Validate and run a MongoDB query.
         Steps:
         - Fix brackets (optional)
-        - Wrap non-lambdas into lambda db: ...
-        - Check syntax
+        - Compile the query into a pymongo operation (see QueryCompiler)
         - Run the query
         """
+        query_str, _ = self.run_query(query_str, attempt_fix)
+        return query_str
+
+    def explain_query(self, query_str, attempt_fix=True):
+        """
+        Returns (compiled_query, explain output) for a query, or (None, None) if it cannot be explained.
+        """
         query_str = textwrap.dedent(query_str)
+        if attempt_fix:
+            query_str = self.auto_fix_brackets(query_str)
+        try:
+            compiled_query = self.query_compiler.compile(query_str)
+            return compiled_query, compiled_query.explain(self.db)
+        except Exception as e:
+            self.logger.error(f"Cannot explain query: {e}")
+            return None, None
 
+    def query_key(self, query_str, attempt_fix=True):
+        """Returns the canonical key of a query's operation, or None if it does not compile."""
+        query_str = textwrap.dedent(query_str)
         if attempt_fix:
             query_str = self.auto_fix_brackets(query_str)
+        try:
+            return self.query_compiler.compile(query_str).key
+        except QueryCompileError:
+            return None
 
-        query_str = self._wrap_if_not_lambda(query_str)
-        if query_str is None:
-            return False
+    def run_query(self, query_str, attempt_fix=True, result_limit=None, database=None):
+        """
+        Validate and run a MongoDB query like validate_query, keeping its result.
 
-        if not self._is_valid_syntax(query_str):
-            return False
+        Args:
+            result_limit (int): Maximum number of documents read from a cursor, or None to read all.
+            database (str): Database to run the query against instead of the current one.
 
-        try:
-            query_lambda = eval(query_str)
+        Returns:
+            tuple: (query_str, result). query_str is the validated query or False if the query is
+            invalid. result is a dict holding the "operation" called on the collection, its
+            "result" and whether the documents were "truncated" to result_limit.
+        """
+        query_str = textwrap.dedent(query_str)
 
-            if not callable(query_lambda):
-                self.logger.error("Evaluated query is not callable. Expected a lambda.")
-                return False
+        if attempt_fix:
+            query_str = self.auto_fix_brackets(query_str)
+
+        try:
+            compiled_query = self.query_compiler.compile(query_str)
+        except QueryCompileError as e:
+            self.logger.error(f"Cannot compile query: {e}")
+            return False, None
 
-            result = query_lambda(self.db)
+        try:
+            db = self.db if database is None else self.client[database]
+            result = compiled_query.execute(db)
+            truncated = False
 
             if hasattr(result, '__iter__') and not isinstance(result, dict):
-                list(result)  # Force evaluation of cursor
+                if result_limit is None:
+                    result = list(result)  # Force evaluation of cursor
+                else:
+                    documents = list(itertools.islice(result, result_limit + 1))
+                    if hasattr(result, 'close'):
+                        result.close()
+                    truncated = len(documents) > result_limit
+                    result = documents[:result_limit]
 
-            return query_str
+            return query_str, {"operation": compiled_query.operation,
+                               "result": result, "truncated": truncated}
 
         except Exception as e:
             self.logger.error(f"Query runtime error: {e}")
-            return False
+            return False, None
@@ -1,24 +1,82 @@
 import csv
+import hashlib
+import json
 import re
 import os
+import textwrap
 from config import (
     PROMPT_RESULT_DIR, OUTPUT_DIR,
     ERROR_FILES_DIR, DB_ERRORS_DIR,
-    OUTPUT_CSV_DIR, COLLECTION_INFO_DIR)
+    OUTPUT_CSV_DIR, COLLECTION_INFO_DIR,
+    ANSWER_MODE, ANSWER_RESULT_LIMIT, STATIC_VALIDATION, PROFILE_QUERIES,
+    SANDBOX_VALIDATION, DATABASE, CLEAN_INDEX_FILE, INCREMENTAL_CLEANING, RESULT_STORE)
 from project_logger import setup_project_logger
 from DataReader import DataReader
-from DBManager import DBManager
+from AnswerFormatter import AnswerFormatter
+from SchemaValidator import SchemaValidator
+from QueryProfiler import QueryProfiler
+from SandboxBuilder import SandboxBuilder
+from PromptGenerator import query_type_id, matches_query_types
+
+# Bump when a change to the cleaning logic should reprocess every prompt result
+CLEANER_VERSION = 1
 
 class DataCleaner:
     logger = setup_project_logger("DataCleaner")
     
-    def __init__(self):
+    def __init__(self, answer_mode: str = ANSWER_MODE, static_validation: bool = STATIC_VALIDATION,
+                 profile_queries: bool = PROFILE_QUERIES, sandbox_validation: bool = SANDBOX_VALIDATION,
+                 refresh_sandbox: bool = False, incremental: bool = INCREMENTAL_CLEANING,
+                 result_store: bool = RESULT_STORE):
         PROMPT_RESULT_DIR.mkdir(exist_ok=True)
         OUTPUT_DIR.mkdir(exist_ok=True)        
         OUTPUT_CSV_DIR.mkdir(exist_ok=True)
+        ERROR_FILES_DIR.mkdir(exist_ok=True)
+        DB_ERRORS_DIR.mkdir(exist_ok=True)
         self.reader = DataReader()
-        self.db_manager = DBManager()
+        self._db_manager = None
+        self.answer_mode = answer_mode
+        self.answer_formatter = AnswerFormatter() if answer_mode == "execute" else None
+        self.derived_answers = None
+        self.static_validation = static_validation
+        # Field-path indexes are built once per collection
+        self.schema_validators = {}
+        self.schema_validator = None
+        self.profile_queries = profile_queries
+        self._query_profiler = None
+        self.query_profiles = {}
+        self.sandbox_validation = sandbox_validation
+        self.refresh_sandbox = refresh_sandbox
+        self.incremental = incremental
+        # Prompt result file -> fingerprint, output file, error report sections and query profiles
+        self.clean_index = {}
+        self.file_errors = []
+        self.use_result_store = result_store
+        self._result_store = None
+        # Result name -> metadata of the latest stored result, when reading from the result store
+        self.stored_results = {}
         
+    @property
+    def db_manager(self):
+        """The MongoDB connection, opened on first use so that writing prompt results needs no database."""
+        if self._db_manager is None:
+            from DBManager import DBManager
+            self._db_manager = DBManager()
+        return self._db_manager
+
+    @property
+    def result_store(self):
+        if self._result_store is None:
+            from ResultStore import ResultStore
+            self._result_store = ResultStore()
+        return self._result_store
+
+    @property
+    def query_profiler(self):
+        if self.profile_queries and self._query_profiler is None:
+            self._query_profiler = QueryProfiler(self.db_manager)
+        return self._query_profiler
+
     def _write_to_file(self, content:str, filename: str):
         try:
             with open(filename, 'w') as file:
@@ -35,7 +93,22 @@ class DataCleaner:
         except Exception as e:
             self.logger.error(f"Failed to write data to {filename}: {str(e)}")
             
-    def _write_to_csv(self, filename: str, *args):
+    def _write_atomic(self, content: str, filename):
+        """
+        Writes the file through a temporary file so readers never see a partial report.
+        Returns whether the file was written.
+        """
+        temp_file = f"{filename}.tmp"
+        try:
+            with open(temp_file, 'w') as file:
+                file.write(content)
+            os.replace(temp_file, filename)
+            return True
+        except Exception as e:
+            self.logger.error(f"Failed to write data to {filename}: {str(e)}")
+            return False
+
+    def _write_to_csv(self, filename: str, *args, header=("Question", "Answer", "Query")):
         lists_to_zip = []
         for arg in args:
             if isinstance(arg, list):
@@ -50,14 +123,19 @@ class DataCleaner:
         try:
             with open(filename, 'w', newline='') as csvfile:
                 writer = csv.writer(csvfile)
-                writer.writerow(["Question", "Answer", "Query"])  # header row
+                writer.writerow(list(header))  # header row
                 for row in zip(*lists_to_zip):
                     writer.writerow(row)
             self.logger.info(f"Data written to {filename}")                
         except Exception as e:
             self.logger.error(f"Failed to write data to {filename}: {str(e)}")
 
-    def write_prompt_output(self, collection_name: str, query_type: dict, output: str):
+    def write_prompt_output(self, collection_name: str, query_type: dict, output: str, run_id: str = ""):
+        if self.use_result_store:
+            section, subsection = query_type_id(query_type["section"], query_type["subsection"]).split("_")
+            self.result_store.append(collection_name, section, subsection, output, run_id)
+            self.logger.info(f"Prompt result for {collection_name}_{section}_{subsection} stored")
+            return
         query_type_str = str(query_type["section"]) + str(query_type["subsection"])
         numbers = re.findall(r'\d+', query_type_str.replace(".", ""))
         query_type = '_'.join(numbers)
@@ -73,8 +151,116 @@ class DataCleaner:
         self.search_terms = self.content[questions_end_index:searches_end_index].split('\n')[1:]
         self.answers = self.content[searches_end_index:].split('\n')[1:]
         
+    def _load_json_content(self):
+        """
+        Loads prompt output written in JSON output mode into self.json_items and self.queries.
+
+        Returns:
+            bool: False if the content is free text, so the text parser should be used.
+        """
+        stripped = self.content.lstrip()
+        if not stripped.startswith(("{", "[")):
+            return False
+        try:
+            data = self.reader.parse_json_content(stripped)
+        except ValueError:
+            self.logger.warning("Prompt output looks like JSON but could not be parsed, falling back to text parser.")
+            return False
+        
+        items = data.get("queries") if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            return False
+        self.json_items = [item for item in items if isinstance(item, dict) and item.get("query")]
+        self.queries = [str(item["query"]).strip() for item in self.json_items]
+        return True
+    
+    def _extract_json_to_lists(self, file):
+        self.all_questions_list = []
+        self.all_answers_list = []
+        self.all_queries_list = []
+        missing_questions_answers = []
+        valid_queries = set(self.queries)
+        
+        for item in self.json_items:
+            query = str(item["query"]).strip()
+            if query not in valid_queries:
+                continue
+            
+            questions_list = list(set(str(q).strip() for q in item.get("questions", []) if str(q).strip()))
+            search_terms_list = [str(t).strip() for t in item.get("search_terms", []) if str(t).strip()]
+            answers_list = [str(a).strip() for a in item.get("answers", []) if str(a).strip()]
+            if self.derived_answers is not None:
+                answers_list = [self.derived_answers[query]] if self.derived_answers.get(query) else []
+            
+            if not (questions_list or search_terms_list) or not answers_list:
+                self.logger.warning(f"No question or answer found with query: {query}")
+                missing_questions_answers.append(query)
+                continue
+            
+            extra_questions = len(questions_list) - len(answers_list)
+            extra_search_terms = len(search_terms_list)
+            answers_list += ([answers_list[0]] * extra_questions) + ([answers_list[-1]] * extra_search_terms)
+            # Keep one answer per question and search term so the rows stay aligned
+            answers_list = answers_list[:len(questions_list) + len(search_terms_list)]
+            
+            self.all_questions_list += questions_list
+            self.all_questions_list += search_terms_list
+            self.all_answers_list += answers_list
+            self.all_queries_list += [query]*len(answers_list)
+        
+        if len(missing_questions_answers)>0:
+            missing_questions_answers_str = f"\nMISSING QUESTIONS OR ANSWERS-{file}:" + '\n' + '\n'.join(missing_questions_answers) + "\n"
+            self.file_errors.append(missing_questions_answers_str)
+
+    def _static_check(self, mapped_query: str):
+        """
+        Checks a query against the collection schema without running it.
+
+        Returns:
+            list: The reasons the query is invalid; empty if it should be sent to the database.
+        """
+        if self.schema_validator is None:
+            return []
+        from QueryCompiler import QueryCompileError
+        query_str = self.db_manager.auto_fix_brackets(textwrap.dedent(mapped_query))
+        try:
+            compiled_query = self.db_manager.query_compiler.compile(query_str)
+        except QueryCompileError as e:
+            return [str(e)]
+        reasons, warnings = self.schema_validator.check(compiled_query)
+        if warnings:
+            self.logger.warning(f"Fields not in the schema of {self.collection_name}: {mapped_query} ({'; '.join(warnings)})")
+        return reasons
+
+    def _run_validation(self, query: str, mapped_query: str):
+        """
+        Validates a query against the database and, in execute answer mode, renders its answer.
+
+        Returns:
+            tuple: (validated_query, answer, profile); validated_query is False if the query is invalid.
+        """
+        answer, profile = None, None
+        if self.derived_answers is None:
+            validated_query = self.db_manager.validate_query(mapped_query)
+        else:
+            # Answers must come from the full data, not the sandbox sample
+            validated_query, query_result = self.db_manager.run_query(mapped_query, result_limit=ANSWER_RESULT_LIMIT,
+                                                                      database=DATABASE)
+            if validated_query:
+                try:
+                    answer = self.answer_formatter.format(query_result)
+                except Exception as e:
+                    # Only this query loses its answer; the rest of the prompt result is kept
+                    self.logger.error(f"Failed to render the answer of {mapped_query}: {e}")
+        if validated_query and self.query_profiler is not None:
+            profile = self.query_profiler.profile(self.collection_name, query, mapped_query)
+        return validated_query, answer, profile
+
     def _validate_queries(self, file:str, mappings:dict):
         invalid_queries = []
+        # Outcome by compiled operation, so copies of a query that differ only in formatting
+        # are sent to the database once
+        outcomes = {}
         for i, query in enumerate(self.queries):
             self.logger.info(f"Processing query number {i+1} of {len(self.queries)}")
             if query.startswith("db."):
@@ -84,7 +270,25 @@ class DataCleaner:
                 for key, value in mappings.items():
                     mapped_query = mapped_query.replace(f'{key}', f'{value}')
 
-                validated_query = self.db_manager.validate_query(mapped_query)
+                reasons = self._static_check(mapped_query)
+                if reasons:
+                    self.logger.info(f"Query rejected by static validation: {mapped_query} ({'; '.join(reasons)})")
+                    invalid_queries.append(f"{mapped_query} -- {'; '.join(reasons)}")
+                    self.queries[i] = ""
+                    continue
+
+                operation_key = self.db_manager.query_key(mapped_query)
+                if operation_key is not None and operation_key in outcomes:
+                    self.logger.info(f"Reusing the validation of an equivalent query for {mapped_query}")
+                    validated_query, answer, profile = outcomes[operation_key]
+                else:
+                    validated_query, answer, profile = self._run_validation(query, mapped_query)
+                    if operation_key is not None:
+                        outcomes[operation_key] = (validated_query, answer, profile)
+                if answer is not None:
+                    self.derived_answers[query] = answer
+                if profile is not None:
+                    self.query_profiles[query] = profile
                 if not validated_query:
                     self.logger.info(f"Invalid query: {mapped_query}")
                     invalid_queries.append(mapped_query)
@@ -96,7 +300,7 @@ class DataCleaner:
         # Convert the list "invalid_queries" to string, with each element in a new line
         if len(invalid_queries) > 0:
             invalid_queries_str = f"\nINVALID QUERIES-{file}\n" + '\n'.join(invalid_queries) + '\n'
-            self._append_to_file(invalid_queries_str, self.db_error_file_name)
+            self.file_errors.append(invalid_queries_str)
 
     def _extract_to_lists(self, file):
                 
@@ -122,7 +326,8 @@ class DataCleaner:
             try:
                 questions_query_index = next(i for i, q in enumerate(self.questions) if query.lower() in q.lower())
                 search_terms_query_index = next(i for i, q in enumerate(self.search_terms) if query.lower() in q.lower())
-                answers_query_index = next(i for i, q in enumerate(self.answers) if query.lower() in q.lower())
+                if self.derived_answers is None:
+                    answers_query_index = next(i for i, q in enumerate(self.answers) if query.lower() in q.lower())
             except StopIteration:
                 self.logger.warning(f"No question found with query: {query}")
                 missing_questions_answers.append(query)
@@ -138,21 +343,23 @@ class DataCleaner:
             temp_indexes = [i for i in newlines_search_terms if i > search_terms_query_index]
             next_search_terms_index = min(temp_indexes) if temp_indexes else len(self.search_terms)-1
             
-            temp_indexes = [i for i in newlines_answers if i > answers_query_index]
-            next_answer_index = min(temp_indexes) if temp_indexes else len(self.answers)-1
-            
             if next_question_index + 1 == len(self.questions):
                 next_question_index += 1
                 
             if next_search_terms_index + 1 == len(self.search_terms):
                 next_search_terms_index += 1
             
-            if next_answer_index + 1 == len(self.answers):
-                next_answer_index += 1            
+            if self.derived_answers is None:
+                temp_indexes = [i for i in newlines_answers if i > answers_query_index]
+                next_answer_index = min(temp_indexes) if temp_indexes else len(self.answers)-1
+                
+                if next_answer_index + 1 == len(self.answers):
+                    next_answer_index += 1
+                
+                answers_list = self.answers[answers_query_index:next_answer_index]
             
             questions_list = self.questions[questions_query_index:next_question_index]
             search_terms_list = self.search_terms[search_terms_query_index:next_search_terms_index]
-            answers_list = self.answers[answers_query_index:next_answer_index]
             
             questions_list = [q for q in questions_list if "Question" in q]
             questions_list = [q.replace("*", "").strip() for q in questions_list]
@@ -172,6 +379,10 @@ class DataCleaner:
                     cleaned_answers_list.append(':'.join(parts[1:]).strip())
             answers_list = cleaned_answers_list
             
+            if self.derived_answers is not None:
+                # Answers rendered from the executed query replace the LLM answers section
+                answers_list = [self.derived_answers[query]] if self.derived_answers.get(query) else []
+            
             if not answers_list:
                 self.logger.warning(f"No answer found with query: {query}")
                 missing_questions_answers.append(query)
@@ -191,7 +402,7 @@ class DataCleaner:
         
         if len(missing_questions_answers)>0:
             missing_questions_answers_str = f"\nMISSING QUESTIONS OR ANSWERS-{file}:" + '\n' + '\n'.join(missing_questions_answers) + "\n"
-            self._append_to_file(missing_questions_answers_str, self.db_error_file_name)
+            self.file_errors.append(missing_questions_answers_str)
     
     def clean_file_names(self):
         prompt_result_files = []
@@ -210,24 +421,26 @@ class DataCleaner:
         self.logger.info("File names cleaned successfully.")
         return prompt_result_files
         
-    def filter_files(self, files):
-        query_types = self.reader.read_query_types_file()
+    def filter_files(self, files, collections: list | None = None, query_types: list | None = None):
+        """Keep the prompt result files of known collections and query types, optionally only the given ones."""
+        all_query_types = self.reader.read_query_types_file()
         
         files_prefixes = []
         for file in os.listdir(COLLECTION_INFO_DIR):
             files_prefixes.append(file.replace(".json", ""))
         
         files_suffixes = []
-        for section_info in query_types:
+        for section_info in all_query_types:
             section = section_info["section"]
             for subsection in section_info["subsections"]:
-                suffix = "_" + "".join(re.findall(r'\d', section)) \
-                    + "_" + "".join(re.findall(r'\d', subsection)) \
-                    + ".txt"
-                files_suffixes.append(suffix)
+                type_id = query_type_id(section, subsection)
+                if matches_query_types(type_id, query_types):
+                    files_suffixes.append(f"_{type_id}.txt")
         
         prefix_filtered_files = []
         for file in files:
+            if collections and "_".join(file.split("_")[:-2]) not in collections:
+                continue
             for file_prefix in files_prefixes:
                 if file.startswith(file_prefix):
                     prefix_filtered_files.append(file)
@@ -242,47 +455,204 @@ class DataCleaner:
                 
         return files_to_process
         
-    def clean_prompt_output(self):        
-        files = self.clean_file_names()
-        files_to_process = self.filter_files(files)
+    def _use_sandbox(self, collections):
+        """Samples the given collections into the sandbox database and validates queries against it."""
+        collections_info = [self.reader.read_collection_info_file(file)
+                            for file in os.listdir(COLLECTION_INFO_DIR)
+                            if str(file).endswith(".json") and str(file)[:-len(".json")] in collections]
+        sandbox_database = SandboxBuilder(self.db_manager).build(collections_info, force=self.refresh_sandbox)
+        self.db_manager.use_database(sandbox_database)
+        if self.answer_mode == "execute":
+            self.logger.warning("Execute answer mode runs every valid query against the full database.")
+
+    def _load_clean_index(self):
+        if not CLEAN_INDEX_FILE.exists():
+            return {}
+        try:
+            with open(CLEAN_INDEX_FILE) as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Ignoring unreadable clean index {CLEAN_INDEX_FILE}: {e}")
+            return {}
+
+    def _save_clean_index(self):
+        self._write_atomic(json.dumps(self.clean_index, default=str), CLEAN_INDEX_FILE)
+
+    def _fingerprint(self, file: str, collection_info: dict):
+        """
+        Returns the source and content hash of a prompt result and the fingerprint of its
+        cleaning inputs: the content, the collection info (mappings and schema), the cleaner
+        version and the settings that change the output. Stored results carry their hash; files
+        whose size and modification time are unchanged are not hashed again.
+        """
+        if file in self.stored_results:
+            stored_result = self.stored_results[file]
+            source = {"result_id": stored_result["id"], "input_hash": stored_result["content_hash"]}
+        else:
+            stat = os.stat(PROMPT_RESULT_DIR / file)
+            entry = self.clean_index.get(file, {})
+            if entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+                input_hash = entry["input_hash"]
+            else:
+                with open(PROMPT_RESULT_DIR / file, 'rb') as prompt_file:
+                    input_hash = hashlib.sha256(prompt_file.read()).hexdigest()
+            source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "input_hash": input_hash}
+        input_hash = source["input_hash"]
+        info_hash = hashlib.sha256(json.dumps(collection_info, sort_keys=True, default=str).encode()).hexdigest()
+        settings = [self.answer_mode, ANSWER_RESULT_LIMIT, self.static_validation, self.profile_queries, self.sandbox_validation]
+        fingerprint = hashlib.sha256(json.dumps([input_hash, info_hash, CLEANER_VERSION, settings]).encode()).hexdigest()
+        return {**source, "fingerprint": fingerprint}
+
+    def _is_unchanged(self, file: str, fingerprint: dict):
+        entry = self.clean_index.get(file)
+        return (self.incremental and entry is not None and entry["fingerprint"] == fingerprint["fingerprint"]
+                and os.path.exists(entry["output"]))
+
+    def _write_error_reports(self, collection_names):
+        """
+        Rewrites the invalid queries report of each collection from the errors recorded for its
+        prompt result files, so reports hold each error once however often cleaning runs.
+        """
+        for collection_name in collection_names:
+            sections = []
+            for file in sorted(self.clean_index):
+                if "_".join(file.split("_")[:-2]) == collection_name:
+                    sections += self.clean_index[file]["errors"]
+            report_file = DB_ERRORS_DIR / f"{collection_name}_invalid_queries.txt"
+            if sections:
+                if self._write_atomic("".join(sections), report_file):
+                    self.logger.info(f"Invalid queries report written to {report_file}")
+            elif report_file.exists():
+                os.remove(report_file)
+
+    def clean_prompt_output(self, collections: list | None = None, query_types: list | None = None):
+        """
+        Clean the prompt results, optionally only those of the given collections and query types.
+        Files cleaned by an earlier run with the same fingerprint are skipped; construct the
+        cleaner with incremental=False (app.py clean --full) to reprocess them, e.g. after the
+        database changed.
+        """
+        if self.use_result_store:
+            if PROMPT_RESULT_DIR.exists() and any(PROMPT_RESULT_DIR.glob("*.txt")):
+                # Results written as text files before the store was used are picked up once
+                self.clean_file_names()
+                self.result_store.import_files(PROMPT_RESULT_DIR, only_missing=True)
+            self.stored_results = {self.result_store.result_name(result): result
+                                   for result in self.result_store.latest(collections)}
+            files = list(self.stored_results)
+        else:
+            files = self.clean_file_names()
+        files_to_process = self.filter_files(files, collections, query_types)
+        self.clean_index = self._load_clean_index()
+        # Entries of deleted prompt results are dropped along with their errors
+        existing_files = set(files)
+        self.clean_index = {file: entry for file, entry in self.clean_index.items()
+                            if file in existing_files or (collections and "_".join(file.split("_")[:-2]) not in collections)}
+        sandbox_ready = False
+        skipped_count = 0
+        failed_count = 0
+        cleaned_collections = set()
         
-        for file in files_to_process:
-            parts = file.split("_")
-            self.collection_name = "_".join(parts[:-2])
-            mappings = self.reader.read_collection_info_file(f"{self.collection_name}.json")["mappings"]
-            self.db_error_file_name = DB_ERRORS_DIR / f"{self.collection_name}_invalid_queries.txt"
-            try:
-                self.logger.info(f"Prompt output started processed for {file}")
-                self.content = self.reader.read_prompt_output_file(file)
-                
-                self._seperate_sections()
-                self._validate_queries(file, mappings)
-                
-                output_file = file.replace(".txt", ".csv")
-                if len(self.queries) > 0:
-                    self._extract_to_lists(file)
+        try:
+            for file in files_to_process:
+                parts = file.split("_")
+                self.collection_name = "_".join(parts[:-2])
+                cleaned_collections.add(self.collection_name)
+                collection_info = self.reader.read_collection_info_file(f"{self.collection_name}.json")
+                mappings = collection_info["mappings"]
+                fingerprint = self._fingerprint(file, collection_info)
+                if self._is_unchanged(file, fingerprint):
+                    skipped_count += 1
+                    if self.query_profiler is not None:
+                        # Keep the profiles of skipped files in the rewritten reports
+                        self.query_profiler.profiles.setdefault(self.collection_name, {}).update(self.clean_index[file]["profiles"])
+                    continue
+                if self.sandbox_validation and not sandbox_ready:
+                    # Only the collections with results to clean are sampled
+                    self._use_sandbox({"_".join(name.split("_")[:-2]) for name in files_to_process})
+                    sandbox_ready = True
+                if self.static_validation:
+                    if self.collection_name not in self.schema_validators:
+                        self.schema_validators[self.collection_name] = SchemaValidator(collection_info)
+                    self.schema_validator = self.schema_validators[self.collection_name]
+                try:
+                    self.logger.info(f"Prompt output started processed for {file}")
+                    if file in self.stored_results:
+                        self.content = self.result_store.read(self.stored_results[file]["id"])
+                    else:
+                        self.content = self.reader.read_prompt_output_file(file)
+                    # In execute mode answers are rendered from the results of the validated queries
+                    self.derived_answers = {} if self.answer_mode == "execute" else None
+                    self.query_profiles = {}
+                    self.file_errors = []
                     
-                    mapped_query_list = []
-                    for query in self.all_queries_list:
-                        # Replace actual field names from mappings
-                        for key, value in mappings.items():
-                            query = str(query).replace(key, value)
-                        mapped_query_list.append(query)
+                    is_json = self._load_json_content()
+                    if not is_json:
+                        self._seperate_sections()
+                    self._validate_queries(file, mappings)
+                    
+                    output_file = file.replace(".txt", ".csv")
+                    if len(self.queries) > 0:
+                        if is_json:
+                            self._extract_json_to_lists(file)
+                        else:
+                            self._extract_to_lists(file)
                         
-                    self._write_to_csv(OUTPUT_CSV_DIR / output_file, self.all_questions_list, self.all_answers_list, mapped_query_list)
-                else:
-                    self.logger.info(f"No queries found for {file}")
-                    self.all_questions_list = []
-                    self.all_answers_list = []
-                    self._write_to_csv(ERROR_FILES_DIR / output_file, self.all_questions_list, self.all_answers_list, self.queries)
-
-            except Exception as e:
-                src = PROMPT_RESULT_DIR / file
-                dest = ERROR_FILES_DIR / file
-                import shutil
-                shutil.copy(src, dest)
-                self.logger.error(f"An unexpected error occurred during processing {file}: {e}")
+                        mapped_query_list = []
+                        for query in self.all_queries_list:
+                            # Replace actual field names from mappings
+                            for key, value in mappings.items():
+                                query = str(query).replace(key, value)
+                            mapped_query_list.append(query)
+                        
+                        output_path = OUTPUT_CSV_DIR / output_file
+                        if self.query_profiler is None:
+                            self._write_to_csv(output_path, self.all_questions_list, self.all_answers_list, mapped_query_list)
+                        else:
+                            # Annotate each row with the cost of its query
+                            profiles = [self.query_profiles.get(query) or {} for query in self.all_queries_list]
+                            self._write_to_csv(output_path, self.all_questions_list, self.all_answers_list, mapped_query_list,
+                                               [p.get("plan", "") for p in profiles],
+                                               [p.get("docs_examined", "") for p in profiles],
+                                               [p.get("returned", "") for p in profiles],
+                                               [",".join(p.get("flags", [])) for p in profiles],
+                                               header=("Question", "Answer", "Query", "Plan", "Docs Examined", "Docs Returned", "Cost Flags"))
+                    else:
+                        self.logger.info(f"No queries found for {file}")
+                        self.all_questions_list = []
+                        self.all_answers_list = []
+                        output_path = ERROR_FILES_DIR / output_file
+                        self._write_to_csv(output_path, self.all_questions_list, self.all_answers_list, self.queries)
+                    
+                    previous_output = self.clean_index.get(file, {}).get("output")
+                    if previous_output and previous_output != str(output_path) and os.path.exists(previous_output):
+                        os.remove(previous_output)
+                    self.clean_index[file] = {**fingerprint, "output": str(output_path), "errors": self.file_errors,
+                                              "profiles": {query: profile for query, profile in self.query_profiles.items() if profile}}
 
+                except Exception as e:
+                    # Failed files are not indexed, so the next run retries them, and the output of
+                    # an earlier clean is removed so it is not collated with the failed result
+                    failed_count += 1
+                    previous_output = self.clean_index.pop(file, {}).get("output")
+                    if previous_output and os.path.exists(previous_output):
+                        os.remove(previous_output)
+                    dest = ERROR_FILES_DIR / file
+                    if file in self.stored_results:
+                        self._write_to_file(self.result_store.read(self.stored_results[file]["id"]), dest)
+                    else:
+                        src = PROMPT_RESULT_DIR / file
+                        import shutil
+                        shutil.copy(src, dest)
+                    self.logger.error(f"An unexpected error occurred during processing {file}: {e}")
+        finally:
+            self._write_error_reports(cleaned_collections)
+            self._save_clean_index()
+        
+        self.logger.info(f"Cleaned {len(files_to_process) - skipped_count - failed_count} prompt results, "
+                         f"skipped {skipped_count} unchanged, {failed_count} failed.")
+        if self.query_profiler is not None:
+            self.query_profiler.write_reports()
 
 if __name__ == "__main__":
     # # Delete all files in error directories
@@ -1,10 +1,24 @@
-import pandas as pd
+import csv
+import math
 import os
+import re
 import shutil
-from config import OUTPUT_DIR, OUTPUT_CSV_DIR, USER_DIR, PERMENANT_QUERY_TYPES_FILE
+from config import (
+    OUTPUT_DIR, OUTPUT_CSV_DIR, USER_DIR, PERMENANT_QUERY_TYPES_FILE,
+    PROMPT_RESULT_DIR, ERROR_FILES_DIR, DB_ERRORS_DIR, RESULT_STORE)
 from DataReader import DataReader
+from PromptGenerator import matches_query_types
 from project_logger import setup_project_logger
 
+REPORT_COLUMNS = ("prompt_results", "csv_files", "csv_rows", "error_files", "invalid_queries")
+
+# Excel sheet limits; the first row of every sheet holds the header
+EXCEL_MAX_ROWS = 1048576
+SHEET_NAME_MAX_LENGTH = 31
+INVALID_SHEET_NAME_CHARS = re.compile(r"[\[\]:*?/\\]")
+# Columns written as text even when they look like numbers
+TEXT_COLUMNS = {"Question", "Answer", "Query", "Section", "Subsection"}
+
 class DataCollator:
     logger = setup_project_logger("DataCollator")
     
@@ -14,67 +28,215 @@ class DataCollator:
         self.user_output_file = USER_DIR / "output.xlsx"
         self.reader = DataReader()
 
-    def collate_csv_to_excel(self):
-        """
-        Collates multiple CSV files into a single Excel file with sheets
-        named after the collection_name of the CSV filenames.
+    def _collection_name(self, filename: str):
+        return "_".join(filename.split('_')[:-2])
 
-        Args:
-            output_excel_filename (str): The name of the output Excel file.
+    def _query_type_id(self, filename: str):
+        """The query type id of a result file name, e.g. "1_12" for "cars_1_12.csv"."""
+        return "_".join(os.path.splitext(filename)[0].split('_')[-2:])
+
+    def _sheet_name(self, collection_name: str, part: int, used_names: set):
         """
-        if not os.path.exists(OUTPUT_CSV_DIR):
-            print(f"Error: The directory {OUTPUT_CSV_DIR} does not exist.")
-            return
+        Returns a valid, unique sheet name for a part of a collection: characters Excel rejects are
+        replaced, names are cut to 31 characters and later parts are numbered, e.g. "cars (2)".
+        """
+        base = INVALID_SHEET_NAME_CHARS.sub("_", collection_name).strip("'") or "Sheet"
+        suffix = f" ({part})" if part > 1 else ""
+        name = base[:SHEET_NAME_MAX_LENGTH - len(suffix)] + suffix
+        counter = 1
+        # Sheet names are compared case-insensitively
+        while name.lower() in used_names:
+            marker = f"~{counter}"
+            name = base[:SHEET_NAME_MAX_LENGTH - len(suffix) - len(marker)] + marker + suffix
+            counter += 1
+        used_names.add(name.lower())
+        if name != collection_name:
+            self.logger.info(f"Writing {collection_name} to sheet '{name}'")
+        return name
 
-        # Dictionary to hold dataframes grouped by their collection_name (sheet name)
-        grouped_data = {}
+    def _group_csv_files(self, collections: list | None = None, query_types: list | None = None):
+        """Returns the CSV files of each collection with the section and subsection of each file."""
+        grouped_files = {}
         query_types = self.reader.read_query_types_file(file=PERMENANT_QUERY_TYPES_FILE)
 
-        for filename in os.listdir(OUTPUT_CSV_DIR):
+        for filename in sorted(os.listdir(OUTPUT_CSV_DIR)):
             if filename.endswith(".csv"):
                 filepath = os.path.join(OUTPUT_CSV_DIR, filename)
                 try:
                     # Extract the collection_name
                     parts = filename.split('_')
-                    collection_name = "_".join(parts[:-2])
+                    collection_name = self._collection_name(filename)
+                    if collections and collection_name not in collections:
+                        continue
+                    if not matches_query_types(self._query_type_id(filename), query_types):
+                        continue
                     
                     section_no = int(parts[-2])-1
                     subsection_no = int(str(parts[-1])[1:].split('.')[0])-1
                     section_details = query_types[section_no]
                     section = section_details["section"]
                     subsection = section_details["subsections"][subsection_no]
-                                        
-                    # Read the CSV file
-                    df = pd.read_csv(filepath)
-                    # Remove duplicate "Question" column values
-                    records = len(df)
-                    df = df.drop_duplicates(subset="Question")
-                    dropped_records = records - len(df)
-                    if dropped_records > 0:
-                        self.logger.info(f"Dropped {dropped_records} duplicate records for {section} - {subsection}")
-                    df["Section"] = section
-                    df["Subsection"] = subsection
-
-                    # Append the dataframe to the list for its corresponding collection_name
-                    if collection_name not in grouped_data:
-                        grouped_data[collection_name] = []
-                    grouped_data[collection_name].append(df)
+                    grouped_files.setdefault(collection_name, []).append((filepath, section, subsection))
 
                 except Exception as e:
                     print(f"Error processing file {filename}: {e}")
+        return grouped_files
+
+    def _columns(self, files: list):
+        """Returns the union of the CSV headers of the files, followed by Section and Subsection."""
+        columns = []
+        for filepath, _, _ in files:
+            with open(filepath, newline='', encoding='utf-8') as file:
+                for column in next(csv.reader(file), []):
+                    if column not in columns:
+                        columns.append(column)
+        return columns + ["Section", "Subsection"]
+
+    def _write_cell(self, worksheet, row: int, col: int, column: str, value: str):
+        if value is None or value == "":
+            return
+        if column not in TEXT_COLUMNS:
+            try:
+                number = float(value)
+                if math.isfinite(number):
+                    worksheet.write_number(row, col, number)
+                    return
+            except ValueError:
+                pass
+        worksheet.write_string(row, col, value)
+
+    def collate_csv_to_excel(self, collections: list | None = None, query_types: list | None = None):
+        """
+        Collates multiple CSV files into a single Excel file with sheets
+        named after the collection_name of the CSV filenames.
+
+        Rows are streamed from the CSV files through xlsxwriter's constant memory mode, so memory
+        use does not grow with the number of rows. Collections with more rows than a sheet holds
+        continue on numbered sheets.
+
+        Args:
+            collections (list, optional): Only collate the CSV files of these collections.
+            query_types (list, optional): Only collate the CSV files of these query type ids or sections.
+        """
+        import xlsxwriter
+
+        if not os.path.exists(OUTPUT_CSV_DIR):
+            print(f"Error: The directory {OUTPUT_CSV_DIR} does not exist.")
+            return
+
+        grouped_files = self._group_csv_files(collections, query_types)
 
         # Write the collated data to an Excel file
         try:
-            with pd.ExcelWriter(self.system_output_file, engine='xlsxwriter') as writer:
-                for collection_name, dfs in grouped_data.items():
-                    # Concatenate all dataframes for the current collection_name
-                    combined_df = pd.concat(dfs, ignore_index=True)
-                    # Write to a sheet named after the collection_name
-                    combined_df.to_excel(writer, sheet_name=collection_name, index=False)
+            workbook = xlsxwriter.Workbook(str(self.system_output_file), {"constant_memory": True})
+            header_format = workbook.add_format({"bold": True, "border": 1})
+            used_names = set()
+            for collection_name, files in grouped_files.items():
+                columns = self._columns(files)
+                part, row, worksheet = 0, EXCEL_MAX_ROWS, None
+                for filepath, section, subsection in files:
+                    seen_questions = set()
+                    dropped_records = 0
+                    with open(filepath, newline='', encoding='utf-8') as file:
+                        for record in csv.DictReader(file):
+                            # Remove duplicate "Question" column values
+                            question = record.get("Question")
+                            if question in seen_questions:
+                                dropped_records += 1
+                                continue
+                            seen_questions.add(question)
+                            record["Section"] = section
+                            record["Subsection"] = subsection
+
+                            if row >= EXCEL_MAX_ROWS:
+                                part += 1
+                                worksheet = workbook.add_worksheet(self._sheet_name(collection_name, part, used_names))
+                                worksheet.write_row(0, 0, columns, header_format)
+                                row = 1
+                            for col, column in enumerate(columns):
+                                self._write_cell(worksheet, row, col, column, record.get(column))
+                            row += 1
+                    if dropped_records > 0:
+                        self.logger.info(f"Dropped {dropped_records} duplicate records for {section} - {subsection}")
+                if worksheet is None:
+                    # Collections without rows still get a sheet with the header
+                    worksheet = workbook.add_worksheet(self._sheet_name(collection_name, 1, used_names))
+                    worksheet.write_row(0, 0, columns, header_format)
+                if part > 1:
+                    self.logger.info(f"Split {collection_name} across {part} sheets of at most {EXCEL_MAX_ROWS - 1} rows")
+            workbook.close()
             print(f"Successfully collated CSVs into {self.system_output_file}")
         except Exception as e:
             print(f"Error writing to Excel file {self.system_output_file}: {e}")
 
+    def report(self, collections: list | None = None, query_types: list | None = None):
+        """
+        Prints per collection the number of prompt result files, cleaned CSV rows, error files
+        and invalid queries, read from the files of the last runs, optionally only for the given
+        collections and query types.
+
+        Returns:
+            dict: The counts by collection name.
+        """
+        counts = {}
+        def collection_counts(filename):
+            collection_name = self._collection_name(filename)
+            if not collection_name or (collections and collection_name not in collections):
+                return None
+            if not matches_query_types(self._query_type_id(filename), query_types):
+                return None
+            return counts.setdefault(collection_name, dict.fromkeys(REPORT_COLUMNS, 0))
+
+        result_names = set()
+        if RESULT_STORE:
+            from ResultStore import ResultStore
+            result_names = {ResultStore.result_name(result) for result in ResultStore().latest(collections)}
+            # Text files not imported into the store yet are counted as well
+            if PROMPT_RESULT_DIR.exists():
+                result_names.update(path.name for path in PROMPT_RESULT_DIR.glob("*.txt"))
+            for name in result_names:
+                if (entry := collection_counts(name)) is not None:
+                    entry["prompt_results"] += 1
+        for directory, key in ((PROMPT_RESULT_DIR, "prompt_results"), (ERROR_FILES_DIR, "error_files")):
+            if directory == PROMPT_RESULT_DIR and RESULT_STORE:
+                continue
+            if directory.exists():
+                for path in directory.iterdir():
+                    if path.suffix == ".txt" and (entry := collection_counts(path.name)) is not None:
+                        entry[key] += 1
+
+        if OUTPUT_CSV_DIR.exists():
+            for path in OUTPUT_CSV_DIR.glob("*.csv"):
+                if (entry := collection_counts(path.name)) is None:
+                    continue
+                with open(path, newline='', encoding='utf-8') as file:
+                    entry["csv_files"] += 1
+                    entry["csv_rows"] += max(sum(1 for _ in csv.reader(file)) - 1, 0)
+
+        if DB_ERRORS_DIR.exists():
+            for path in DB_ERRORS_DIR.glob("*_invalid_queries.txt"):
+                collection_name = path.name[:-len("_invalid_queries.txt")]
+                if collections and collection_name not in collections:
+                    continue
+                entry = counts.setdefault(collection_name, dict.fromkeys(REPORT_COLUMNS, 0))
+                # Only the lines of "INVALID QUERIES-<file>" sections are queries; the report also
+                # lists the queries without questions or answers under their own headers
+                in_section = False
+                with open(path, encoding='utf-8') as file:
+                    for line in file:
+                        if line.startswith("INVALID QUERIES-"):
+                            in_section = matches_query_types(self._query_type_id(line.strip()), query_types)
+                        elif line.startswith("MISSING QUESTIONS OR ANSWERS-"):
+                            in_section = False
+                        elif in_section and line.strip():
+                            entry["invalid_queries"] += 1
+
+        width = max([len("collection")] + [len(name) for name in counts])
+        print("collection".ljust(width) + "".join(f"{column:>17}" for column in REPORT_COLUMNS))
+        for collection_name in sorted(counts):
+            print(collection_name.ljust(width) + "".join(f"{counts[collection_name][column]:>17}" for column in REPORT_COLUMNS))
+        return counts
+
     def copy_system_to_user_output(self):
         """
         Creates a copy of the system_output.xlsx file and places it in the user directory
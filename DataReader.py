@@ -1,5 +1,9 @@
 import json
 import csv
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from project_logger import setup_project_logger
 from config import(
     QUERY_TYPES_FILE, PROMPT1_FILE, PROMPT2_FILE, PROMPT3_FILE, PROMPT4_FILE,
@@ -42,6 +46,16 @@ class DataReader:
             self.logger.error(f"Failed to parse JSON in file {filename}: {str(e)}")
             raise
         
+    def parse_json_content(self, content):
+        """Parses JSON text, using orjson when it is installed.
+
+        Raises:
+            ValueError: If the content is not valid JSON.
+        """
+        if orjson is not None:
+            return orjson.loads(content)
+        return json.loads(content)
+
     def _read_file(self, filename):
         try:
             with open(filename, 'r') as file:
@@ -0,0 +1,103 @@
+import sys
+import time
+import uuid
+import socket
+import threading
+import concurrent.futures
+from tenacity import RetryError
+from project_logger import setup_project_logger
+from QueryGenerator import QueryGenerator
+from DBManager import DBManager
+from config import MAX_WORKERS, JOB_HEARTBEAT_SECONDS, LLM_REQUESTS_PER_MINUTE
+
+class JobWorker:
+    """
+    Worker process for distributed generation. Claims prompt-set jobs from the shared MongoDB
+    queue, keeps their leases alive while the chained prompts run and writes the results back.
+    """
+    logger = setup_project_logger("JobWorker")
+
+    def __init__(self, run_id: str, max_workers: int = MAX_WORKERS):
+        self.run_id = run_id
+        self.max_workers = max_workers
+        self.worker_id = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.db_manager = DBManager()
+        self.query_generator = QueryGenerator()
+        self.query_generator.api_manager.rate_limiter = self._wait_for_rate_slot
+
+    def _wait_for_rate_slot(self):
+        """Blocks until the run's global request budget allows another LLM call."""
+        while True:
+            wait_seconds = self.db_manager.acquire_rate_slot(LLM_REQUESTS_PER_MINUTE)
+            if not wait_seconds:
+                return
+            self.logger.debug(f"Global rate budget exhausted, waiting {wait_seconds:.1f}s.")
+            time.sleep(wait_seconds)
+
+    def _heartbeat(self, job_id: str, stop_event: threading.Event):
+        while not stop_event.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                if not self.db_manager.extend_lease(job_id, self.worker_id):
+                    self.logger.warning(f"Lost lease on job {job_id}.")
+                    return
+            except Exception as e:
+                # A transient database error must not stop the heartbeat, or the lease expires mid-job
+                self.logger.error(f"Could not extend the lease on job {job_id}: {e}")
+
+    def _process_job(self, job: dict):
+        job_id = job["_id"]
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, stop_event), daemon=True)
+        heartbeat.start()
+        self.logger.info(f"--- Starting job {job_id} (attempt {job['attempts']})")
+        try:
+            output = self.query_generator.generate_prompt_set_output(job["payload"])
+            if not output:
+                self.db_manager.release_job(job_id, self.worker_id, "One or more chained prompt calls failed.")
+                self.logger.error(f"One or more chained prompt calls failed for job {job_id}.")
+                return False
+            if not self.db_manager.complete_job(job_id, self.worker_id, output):
+                self.logger.warning(f"Lease on job {job_id} expired before its result was written, discarding it.")
+                return False
+            self.logger.info(f"--- Finished job {job_id}")
+            return True
+        except RetryError as e:
+            self.logger.error(f"All retries failed for job {job_id}: {e}")
+            self.db_manager.release_job(job_id, self.worker_id, str(e))
+            return False
+        except Exception as e:
+            self.logger.critical(f"An unexpected error occurred during job {job_id}: {e}", exc_info=True)
+            self.db_manager.release_job(job_id, self.worker_id, str(e))
+            return False
+        finally:
+            stop_event.set()
+
+    def _worker_loop(self):
+        processed_count = 0
+        while True:
+            job = self.db_manager.claim_job(self.run_id, self.worker_id)
+            if job is None:
+                # Jobs leased by other workers may still expire and need to be reclaimed
+                if self.db_manager.job_status_counts(self.run_id).get("leased", 0) == 0:
+                    return processed_count
+                time.sleep(JOB_HEARTBEAT_SECONDS)
+                continue
+            self._process_job(job)
+            processed_count += 1
+
+    def run(self):
+        """Processes jobs until the queue for the run has nothing left to claim."""
+        self.logger.info(f"Worker {self.worker_id} started for run {self.run_id}.")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._worker_loop) for _ in range(self.max_workers)]
+            processed_count = sum(future.result() for future in futures)
+        self.logger.info(f"Worker {self.worker_id} finished after processing {processed_count} jobs.")
+        return processed_count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python JobWorker.py <run_id>")
+        sys.exit(1)
+    worker = JobWorker(sys.argv[1])
+    worker.run()
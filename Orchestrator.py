@@ -1,22 +1,44 @@
 import os
+import time
 import concurrent.futures
 from tenacity import RetryError
 from project_logger import setup_project_logger
 from PromptGenerator import PromptGenerator
-from QueryGenerator import QueryGenerator
-from DataCleaner import DataCleaner
-from DataCollator import DataCollator
-from config import MAX_WORKERS, ERROR_FILES_DIR, DB_ERRORS_DIR
+from config import MAX_WORKERS, ERROR_FILES_DIR, DB_ERRORS_DIR, INCREMENTAL_CLEANING
 
 class Orchestrator:
     logger = setup_project_logger("Orchestrator")
 
-    def __init__(self):
+    def __init__(self, incremental_cleaning: bool = INCREMENTAL_CLEANING, refresh_sandbox: bool = False):
         ERROR_FILES_DIR.mkdir(parents=True, exist_ok=True)
         DB_ERRORS_DIR.mkdir(parents=True, exist_ok=True)
         self.prompt_generator = PromptGenerator()
-        self.query_generator = QueryGenerator()
-        self.data_cleaner = DataCleaner()
+        # Clients are built on first use, so a run of one stage only pays for what it needs
+        self._query_generator = None
+        self._data_cleaner = None
+        self.incremental_cleaning = incremental_cleaning
+        self.refresh_sandbox = refresh_sandbox
+        # Identifies the generation run in the result store
+        self.run_id = ""
+
+    @property
+    def query_generator(self):
+        if self._query_generator is None:
+            from QueryGenerator import QueryGenerator
+            self._query_generator = QueryGenerator()
+        return self._query_generator
+
+    @property
+    def data_cleaner(self):
+        if self._data_cleaner is None:
+            from DataCleaner import DataCleaner
+            self._data_cleaner = DataCleaner(incremental=self.incremental_cleaning, refresh_sandbox=self.refresh_sandbox)
+        return self._data_cleaner
+
+    def _build_clients(self):
+        """Builds the clients up front, so the worker threads share them instead of racing to create them."""
+        self._query_generator = self.query_generator
+        self._data_cleaner = self.data_cleaner
 
     def _process_single_prompt_set(self, prompt_set: dict):
         """
@@ -25,26 +47,16 @@ class Orchestrator:
         """
         collection_name = prompt_set["collection"]
         query_type = prompt_set["query_type"]
-        prompt1 = prompt_set["prompt1"]
-        prompt2 = prompt_set["prompt2"]
-        prompt3 = prompt_set["prompt3"]
-        prompt4 = prompt_set["prompt4"]
 
         log_prefix = f"Collection: {collection_name}, Query Type: {query_type}"
         self.logger.info(f"--- Starting processing for {log_prefix}")
 
         try:
             # 2. Send chained prompts to LLM and get final response
-            output_prompt1, output_prompt2, output_prompt3, output_prompt4 = self.query_generator.send_chained_prompts_to_llm(
-                prompt1, prompt2, prompt3, prompt4,
-                delay_between_steps_seconds=2 # Adjust delay as needed
-            )
+            output = self.query_generator.generate_prompt_set_output(prompt_set)
             
-            if output_prompt1 and output_prompt2 and output_prompt3 and output_prompt4:
-                
-                output = f'''QUERIES:\n{output_prompt1}\nQUESTIONS:\n{output_prompt2}\nSEARCHES:\n{output_prompt3}\nANSWERS:\n{output_prompt4}'''
-                
-                self.data_cleaner.write_prompt_output(collection_name, query_type, output)
+            if output:
+                self.data_cleaner.write_prompt_output(collection_name, query_type, output, self.run_id)
                 self.logger.info(f"--- Finished processing and data written for {log_prefix}")
                 return True
             else:
@@ -58,19 +70,21 @@ class Orchestrator:
             self.logger.critical(f"An unexpected error occurred during processing {log_prefix}: {e}", exc_info=True)
             return False
 
-    def _generate_and_process_prompt_sets(self):
+    def _generate_and_process_prompt_sets(self, collections: list | None = None, query_types: list | None = None):
         """
         Generate and process all prompt sets concurrently.
         """
         
         # 1. Generate all prompt sets
         self.logger.info("Generating chained prompt templates...")
-        all_prompt_sets = self.prompt_generator.generate_prompts()
+        all_prompt_sets = self.prompt_generator.generate_prompts(collections, query_types)
         self.logger.info(f"Finished generating {len(all_prompt_sets)} sets of chained prompt templates.")
 
         # 2. Process each prompt set
         processed_count = 0
         successful_count = 0
+        self.run_id = time.strftime("%Y%m%d-%H%M%S")
+        self._build_clients()
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
             # Submit each prompt set processing to the executor
@@ -92,22 +106,61 @@ class Orchestrator:
                 
         self.logger.info(f"{successful_count} out of {len(all_prompt_sets)} prompt sets processed successfully.")
         
-    def run_workflow(self, generate_prompt_results = True, clean_results = True):
+    def enqueue_generation_jobs(self, run_id: str, collections: list | None = None, query_types: list | None = None):
+        """
+        Queue all prompt sets as jobs for distributed workers (see JobWorker).
+        """
+        self.logger.info(f"Queueing prompt sets for run {run_id}...")
+        return self.prompt_generator.enqueue_prompts(self.data_cleaner.db_manager, run_id, collections, query_types)
+
+    def collect_generation_results(self, run_id: str, poll_seconds: int = 30):
+        """
+        Wait until the workers have finished every job of a run and write the results to the
+        result store (or the prompt results directory).
+        """
+        db_manager = self.data_cleaner.db_manager
+        while True:
+            counts = db_manager.job_status_counts(run_id)
+            self.logger.info(f"--- Progress for run {run_id}: {counts}")
+            if counts.get("pending", 0) == 0 and counts.get("leased", 0) == 0:
+                break
+            time.sleep(poll_seconds)
+
+        written_count = 0
+        for job in db_manager.finished_jobs(run_id):
+            prompt_set = job["payload"]
+            self.data_cleaner.write_prompt_output(prompt_set["collection"], prompt_set["query_type"], job["result"], run_id)
+            written_count += 1
+        self.logger.info(f"{written_count} prompt set results collected for run {run_id} "
+                         f"({counts.get('failed', 0)} failed).")
+        return written_count
+
+    def run_workflow(self, generate_prompt_results = True, clean_results = True, collate_results = None,
+                     collections: list | None = None, query_types: list | None = None):
+        """
+        Run the selected stages, optionally only for the given collections and query types
+        (ids such as "1_12", or section numbers such as "1"). Collation runs with cleaning
+        unless collate_results says otherwise.
+        """
         self.logger.info("Starting LLM project workflow...")
+        if collate_results is None:
+            collate_results = clean_results
                 
         if generate_prompt_results:
             self.logger.info("Generating prompt results.")
-            self._generate_and_process_prompt_sets()
+            self._generate_and_process_prompt_sets(collections, query_types)
             self.logger.info("Prompt results generated successfully.")
             
         if clean_results:
             self.logger.info("Data cleaning started.")
-            self.data_cleaner.clean_prompt_output()
+            self.data_cleaner.clean_prompt_output(collections, query_types)
             self.logger.info("Data cleaning completed.")
             
+        if collate_results:
+            from DataCollator import DataCollator
             self.logger.info("Data collation started.")
             collator = DataCollator()
-            collator.collate_csv_to_excel()
+            collator.collate_csv_to_excel(collections, query_types)
             collator.copy_system_to_user_output()
             self.logger.info("Data collation completed.")
     
@@ -1,12 +1,27 @@
 import os
+import re
 from DataReader import DataReader
-from config import COLLECTION_INFO_DIR
+from config import COLLECTION_INFO_DIR, QUERIES_DIR
 from project_logger import setup_project_logger
 
+# Placeholders that change with every prompt of a collection
+PER_QUERY_PLACEHOLDERS = ("TYPE_OF_QUERY", "EXAMPLE", "QUERIES")
+
+def query_type_id(section: str, subsection: str):
+    """Identifier of a query type as used in prompt result file names, e.g. "1_12"."""
+    return "".join(re.findall(r'\d', section)) + "_" + "".join(re.findall(r'\d', subsection))
+
+def matches_query_types(type_id: str, query_types: list | None):
+    """Whether a query type id is selected by a list of ids or section numbers (e.g. "1" or "1_12")."""
+    if not query_types:
+        return True
+    return any(type_id == query_type or type_id.startswith(f"{query_type}_") for query_type in query_types)
+
 class PromptGenerator:
     logger = setup_project_logger("PromptGenerator")
     
     def __init__(self):
+        QUERIES_DIR.mkdir(parents=True, exist_ok=True)
         COLLECTION_INFO_DIR.mkdir(exist_ok=True)
     
     def _create_query_types_list(self, query_types:list):
@@ -30,13 +45,34 @@ class PromptGenerator:
                     "example": examples[i]
                 })
 
-    def generate_prompts(self):        
+    def _split_template(self, template: str, collection_name: str, schema: str, nle: str):
+        """Split a prompt template into the prefix shared by every prompt of a collection and the
+        per-query remainder, and fill in the collection placeholders of both parts.
+
+        Returns:
+            tuple: (prefix, suffix) where prefix + suffix is the collection-level prompt.
+        """
+        positions = [template.find(marker) for marker in PER_QUERY_PLACEHOLDERS]
+        positions = [position for position in positions if position != -1]
+        split_at = min(positions) if positions else len(template)
+        
+        parts = []
+        for part in (template[:split_at], template[split_at:]):
+            parts.append(part.replace("COLLECTION_NAME", collection_name).replace("SCHEMA", schema).replace("NLE", nle))
+        return parts[0], parts[1]
+
+    def generate_prompts(self, collections: list | None = None, query_types: list | None = None):
+        """Generate the chained prompt sets, optionally only for the given collections and query types."""
         reader = DataReader()
         prompt1_template, prompt2_template, prompt3_template, prompt4_template = reader.read_prompts_files()
-        query_types = reader.read_query_types_file()
+        all_query_types = reader.read_query_types_file()
         
-        self._create_query_types_list(query_types)
+        self._create_query_types_list(all_query_types)
         self.collections_info = [reader.read_collection_info_file(file) for file in os.listdir(COLLECTION_INFO_DIR) if str(file).endswith(".json")]
+        if collections:
+            self.collections_info = [info for info in self.collections_info if info["name"] in collections]
+        selected_query_types = [query_type for query_type in self.query_types_list
+                                if matches_query_types(query_type_id(query_type["section"], query_type["subsection"]), query_types)]
         
         all_template_sets = []
         
@@ -46,29 +82,53 @@ class PromptGenerator:
             mappings = str(collection_info["mappings"])
             nle = str(collection_info["nle"])
             
-            prompt1 = prompt1_template.replace("COLLECTION_NAME", collection_name).replace("SCHEMA", schema).replace("NLE", nle)
-            prompt2 = prompt2_template.replace("COLLECTION_NAME", collection_name).replace("SCHEMA", schema).replace("NLE", nle)
-            prompt3 = prompt3_template.replace("COLLECTION_NAME", collection_name).replace("SCHEMA", schema).replace("NLE", nle)
-            prompt4 = prompt4_template.replace("COLLECTION_NAME", collection_name).replace("SCHEMA", schema).replace("NLE", nle)
+            # The shared per-collection prefix is everything before the first per-query placeholder
+            prefix1, suffix1 = self._split_template(prompt1_template, collection_name, schema, nle)
+            prefix2, suffix2 = self._split_template(prompt2_template, collection_name, schema, nle)
+            prefix3, suffix3 = self._split_template(prompt3_template, collection_name, schema, nle)
+            prefix4, suffix4 = self._split_template(prompt4_template, collection_name, schema, nle)
             
-            for query_type in self.query_types_list:
-                final_prompt1 = prompt1.replace("TYPE_OF_QUERY", f'{query_type["section"]}\n{query_type["subsection"]}')
-                final_prompt2 = prompt2.replace("TYPE_OF_QUERY", f'{query_type["section"]}\n{query_type["subsection"]}')
-                final_prompt3 = prompt3.replace("TYPE_OF_QUERY", f'{query_type["section"]}\n{query_type["subsection"]}')
-                final_prompt4 = prompt4.replace("TYPE_OF_QUERY", f'{query_type["section"]}\n{query_type["subsection"]}')
+            for query_type in selected_query_types:
+                final_prompt1 = suffix1.replace("TYPE_OF_QUERY", f'{query_type["section"]}\n{query_type["subsection"]}')
+                final_prompt2 = suffix2.replace("TYPE_OF_QUERY", f'{query_type["section"]}\n{query_type["subsection"]}')
+                final_prompt3 = suffix3.replace("TYPE_OF_QUERY", f'{query_type["section"]}\n{query_type["subsection"]}')
+                final_prompt4 = suffix4.replace("TYPE_OF_QUERY", f'{query_type["section"]}\n{query_type["subsection"]}')
                 final_prompt1 = final_prompt1.replace("EXAMPLE", f'{query_type["example"]}')
                 final_prompt2 = final_prompt2.replace("EXAMPLE", f'{query_type["example"]}')
                 final_prompt3 = final_prompt3.replace("EXAMPLE", f'{query_type["example"]}')
                 final_prompt4 = final_prompt4.replace("EXAMPLE", f'{query_type["example"]}')
                 
                 all_template_sets.append({"collection" : collection_name, "query_type": query_type,
-                                          "prompt1": final_prompt1, "prompt2": final_prompt2, 
-                                          "prompt3": final_prompt3, "prompt4": final_prompt4
+                                          "prompt1": prefix1 + final_prompt1, "prompt2": prefix2 + final_prompt2, 
+                                          "prompt3": prefix3 + final_prompt3, "prompt4": prefix4 + final_prompt4,
+                                          "prefix1": prefix1, "prefix2": prefix2,
+                                          "prefix3": prefix3, "prefix4": prefix4
                                         })
             self.logger.info(f"Generated queries templates for {collection_name}")
         self.logger.info(f"Finished generating queries templates")
         return all_template_sets
 
+    def enqueue_prompts(self, db_manager, run_id: str, collections: list | None = None, query_types: list | None = None):
+        """
+        Generates all prompt sets and queues them as jobs for distributed workers.
+
+        Args:
+            db_manager (DBManager): The connection holding the shared job queue.
+            run_id (str): Identifies the run the jobs belong to.
+
+        Returns:
+            int: The number of prompt sets in the run.
+        """
+        all_prompt_sets = self.generate_prompts(collections, query_types)
+        jobs = []
+        for prompt_set in all_prompt_sets:
+            query_type = prompt_set["query_type"]
+            job_id = f'{prompt_set["collection"]}:{query_type["section"]}:{query_type["subsection"]}'
+            jobs.append({"job_id": job_id, "payload": prompt_set})
+        db_manager.enqueue_jobs(run_id, jobs)
+        self.logger.info(f"Queued {len(jobs)} prompt sets for run {run_id}")
+        return len(jobs)
+
 
 if __name__ == "__main__":
     gen = PromptGenerator()
@@ -0,0 +1,293 @@
+import ast
+import functools
+from datetime import datetime
+from bson import ObjectId, Decimal128, json_util
+from config import QUERY_CACHE_SIZE
+
+# Read-only collection methods that can be compiled, by the name used in the query
+METHOD_ALIASES = {
+    "find": "find", "find_one": "find_one", "findOne": "find_one",
+    "aggregate": "aggregate",
+    "distinct": "distinct",
+    "count": "count_documents", "count_documents": "count_documents", "countDocuments": "count_documents",
+    "estimated_document_count": "estimated_document_count", "estimatedDocumentCount": "estimated_document_count",
+}
+
+# Chained cursor modifiers allowed after each method
+MODIFIER_ALIASES = {
+    "find": {"sort": "sort", "limit": "limit", "skip": "skip", "hint": "hint",
+             "maxTimeMS": "max_time_ms", "max_time_ms": "max_time_ms",
+             "count": "count", "toArray": None, "pretty": None},
+    "aggregate": {"toArray": None, "pretty": None},
+}
+
+def _parse_date(value: str):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+# Shell constructors allowed inside query arguments
+CONSTRUCTORS = {
+    "ISODate": _parse_date, "Date": _parse_date, "datetime": _parse_date,
+    "ObjectId": ObjectId,
+    "NumberInt": int, "NumberLong": int,
+    "NumberDecimal": Decimal128,
+}
+
+def _quote_operators(text: str):
+    """Quotes bare $ operators outside string literals, e.g. {$gt: 5} becomes {"$gt": 5}."""
+    result, quote, i = [], None, 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            result.append(char)
+            if char == "\\" and i + 1 < len(text):
+                result.append(text[i + 1])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+            result.append(char)
+        elif char == "$":
+            end = i + 1
+            while end < len(text) and (text[end].isalnum() or text[end] in "_."):
+                end += 1
+            result.append(f'"{text[i:end]}"')
+            i = end
+            continue
+        else:
+            result.append(char)
+        i += 1
+    return "".join(result)
+
+# Shell spellings of literals
+NAMED_CONSTANTS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+
+
+class QueryCompileError(ValueError):
+    """Raised when a query is not in the supported db.<collection>.<method>(...) subset."""
+
+
+class CompiledQuery:
+    """
+    A query parsed into a read-only pymongo operation: the collection, the method with its
+    arguments and the chained cursor modifiers. Instances are immutable and safe to share
+    between threads.
+    """
+
+    def __init__(self, text: str, collection: str, method: str, args: tuple, kwargs: dict, modifiers: tuple):
+        self.text = text
+        self.collection = collection
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.modifiers = modifiers
+
+    @property
+    def filter(self):
+        """The filter of a find or count, or None for other methods."""
+        if self.method in ("find", "find_one", "count_documents", "distinct"):
+            position = 1 if self.method == "distinct" else 0
+            if len(self.args) > position:
+                return self.args[position]
+            return self.kwargs.get("filter")
+        return None
+
+    @property
+    def projection(self):
+        if self.method in ("find", "find_one"):
+            return self.args[1] if len(self.args) > 1 else self.kwargs.get("projection")
+        return None
+
+    @property
+    def pipeline(self):
+        if self.method != "aggregate":
+            return None
+        if len(self.args) == 1 and isinstance(self.args[0], list):
+            return self.args[0]
+        # The shell also accepts the stages as separate arguments
+        return list(self.args) or self.kwargs.get("pipeline", [])
+
+    @property
+    def operation(self):
+        """The operation the query performs; a find followed by .count() is a count."""
+        if self.method == "find" and "count" in [name for name, _ in self.modifiers]:
+            return "count"
+        return self.method
+
+    @property
+    def key(self):
+        """
+        Canonical form of the operation, equal for queries that differ only in formatting. Values
+        keep their BSON type, so ObjectId("...") and the plain string "..." have different keys.
+        """
+        return json_util.dumps([self.collection, self.method, self.args, self.kwargs, self.modifiers],
+                               sort_keys=True, json_options=json_util.CANONICAL_JSON_OPTIONS)
+
+    def _sort_spec(self, args):
+        """Returns the arguments for Cursor.sort, which takes key/direction pairs rather than a shell sort document."""
+        if len(args) == 1 and isinstance(args[0], dict):
+            return (list(args[0].items()),)
+        return args
+
+    def _cursor(self, collection):
+        cursor = collection.find(*self.args, **self.kwargs)
+        for name, args in self.modifiers:
+            if name == "sort":
+                cursor = cursor.sort(*self._sort_spec(args))
+            elif name is not None and name != "count":
+                cursor = getattr(cursor, name)(*args)
+        return cursor
+
+    def execute(self, db):
+        """Runs the operation against a pymongo database and returns the pymongo result."""
+        collection = db[self.collection]
+        if self.method == "find":
+            modifier_names = [name for name, _ in self.modifiers]
+            if "count" in modifier_names:
+                count_args = {name: args[0] for name, args in self.modifiers if name in ("skip", "limit") and args}
+                return collection.count_documents(self.filter or {}, **count_args)
+            return self._cursor(collection)
+        if self.method == "aggregate":
+            return collection.aggregate(self.pipeline, **{k: v for k, v in self.kwargs.items() if k != "pipeline"})
+        if self.method == "count_documents" and not self.args and "filter" not in self.kwargs:
+            return collection.count_documents({}, **self.kwargs)
+        return getattr(collection, self.method)(*self.args, **self.kwargs)
+
+    def explain(self, db):
+        """Returns the query planner output for the operation."""
+        if self.method == "find" and "count" not in [name for name, _ in self.modifiers]:
+            return self._cursor(db[self.collection]).explain()
+        if self.method == "aggregate":
+            command = {"aggregate": self.collection, "pipeline": self.pipeline, "cursor": {}}
+            return db.command("explain", command, verbosity="executionStats")
+        if self.method in ("find", "find_one", "count_documents"):
+            command = {"find": self.collection, "filter": self.filter or {}}
+            if self.method == "find_one":
+                command["limit"] = 1
+            return db.command("explain", command, verbosity="executionStats")
+        if self.method == "distinct":
+            command = {"distinct": self.collection, "key": self.args[0] if self.args else self.kwargs.get("key")}
+            if self.filter:
+                command["query"] = self.filter
+            return db.command("explain", command, verbosity="executionStats")
+        return db.command("explain", {"count": self.collection}, verbosity="executionStats")
+
+
+class QueryCompiler:
+    """
+    Parses generated queries in the db.<collection>.<method>(...) shell subset into
+    CompiledQuery objects without evaluating them. Only literals and a few shell constructors
+    (ISODate, ObjectId, ...) are accepted as arguments, and only read operations as methods.
+    Results are cached by query text.
+    """
+
+    def __init__(self, cache_size: int = QUERY_CACHE_SIZE):
+        self._compile_cached = functools.lru_cache(maxsize=cache_size)(self._compile)
+
+    def compile(self, query_str: str) -> CompiledQuery:
+        """
+        Raises:
+            QueryCompileError: If the query is not in the supported subset.
+        """
+        compiled = self._compile_cached(query_str.strip())
+        if isinstance(compiled, str):
+            # Failures are cached as their message; a shared exception object would collect
+            # tracebacks from every thread that raised it
+            raise QueryCompileError(compiled)
+        return compiled
+
+    def _key(self, node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return node.value
+        if isinstance(node, ast.Name):
+            # Unquoted shell keys, e.g. {age: 1}
+            return node.id
+        raise QueryCompileError(f"Unsupported key: {ast.unparse(node)}")
+
+    def _value(self, node):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Dict):
+            if any(key is None for key in node.keys):
+                raise QueryCompileError("Dictionary unpacking is not supported.")
+            return {self._key(key): self._value(value) for key, value in zip(node.keys, node.values)}
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [self._value(item) for item in node.elts]
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)) \
+                and isinstance(node.operand, ast.Constant) and isinstance(node.operand.value, (int, float)):
+            return -node.operand.value if isinstance(node.op, ast.USub) else node.operand.value
+        if isinstance(node, ast.Name) and node.id in NAMED_CONSTANTS:
+            return NAMED_CONSTANTS[node.id]
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in CONSTRUCTORS \
+                and not node.keywords and len(node.args) == 1:
+            try:
+                return CONSTRUCTORS[node.func.id](self._value(node.args[0]))
+            except (TypeError, ValueError) as e:
+                raise QueryCompileError(f"Invalid {node.func.id} value: {e}") from e
+        raise QueryCompileError(f"Unsupported expression: {ast.unparse(node)}")
+
+    def _arguments(self, call: ast.Call):
+        if any(keyword.arg is None for keyword in call.keywords):
+            raise QueryCompileError("Keyword unpacking is not supported.")
+        args = tuple(self._value(arg) for arg in call.args)
+        kwargs = {keyword.arg: self._value(keyword.value) for keyword in call.keywords}
+        return args, kwargs
+
+    def _collection(self, node, calls):
+        """Resolves the collection from db.name, db["name"] or db.getCollection("name")."""
+        if isinstance(node, ast.Name) and node.id == "db" and calls \
+                and calls[0].func.attr in ("getCollection", "get_collection"):
+            args, _ = self._arguments(calls.pop(0))
+            if len(args) == 1 and isinstance(args[0], str):
+                return args[0]
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "db" \
+                and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+            return node.slice.value
+
+        # Collection names may contain dots, e.g. db.sales.archive.find()
+        names = []
+        while isinstance(node, ast.Attribute):
+            names.append(node.attr)
+            node = node.value
+        if isinstance(node, ast.Name) and node.id == "db" and names:
+            return ".".join(reversed(names))
+        raise QueryCompileError("Query must follow format: db.Collection.operation(...)")
+
+    def _compile(self, query_str: str):
+        text = query_str.rstrip(";").strip()
+        if text.startswith("lambda db:"):
+            text = text[len("lambda db:"):].strip()
+        if not text.startswith("db"):
+            return "Query must start with 'db.'"
+        try:
+            node = ast.parse(_quote_operators(text), mode="eval").body
+        except SyntaxError as e:
+            return f"Syntax error in query: {e}"
+
+        try:
+            calls = []
+            while isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+                calls.append(node)
+                node = node.func.value
+            calls.reverse()
+            collection = self._collection(node, calls)
+            if not calls:
+                raise QueryCompileError("Query does not call an operation on the collection.")
+
+            method = METHOD_ALIASES.get(calls[0].func.attr)
+            if method is None:
+                raise QueryCompileError(f"Unsupported operation: {calls[0].func.attr}")
+            args, kwargs = self._arguments(calls[0])
+
+            modifiers = []
+            allowed_modifiers = MODIFIER_ALIASES.get(method, {})
+            for call in calls[1:]:
+                if call.func.attr not in allowed_modifiers:
+                    raise QueryCompileError(f"Unsupported modifier .{call.func.attr}() after {calls[0].func.attr}")
+                modifier_args, modifier_kwargs = self._arguments(call)
+                if modifier_kwargs:
+                    raise QueryCompileError(f"Keyword arguments are not supported for .{call.func.attr}()")
+                modifiers.append((allowed_modifiers[call.func.attr], modifier_args))
+            return CompiledQuery(query_str, collection, method, args, kwargs, tuple(modifiers))
+        except QueryCompileError as e:
+            return str(e)
@@ -1,13 +1,66 @@
+import json
 import time
 from tenacity import RetryError
 from APIManager import APIManager
 from project_logger import setup_project_logger
+from DataReader import DataReader
+from QueryCompiler import QueryCompiler, QueryCompileError
+from config import STREAM_RESPONSES, JSON_OUTPUT, ANSWER_MODE
+
+def _query_items_schema(field: str):
+    return {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "query": {"type": "STRING"},
+                field: {"type": "ARRAY", "items": {"type": "STRING"}},
+            },
+            "required": ["query", field],
+        },
+    }
+
+# Response schemas used to constrain each step of the chain in JSON output mode
+JSON_RESPONSE_SCHEMAS = {
+    "QUERIES": {"type": "ARRAY", "items": {"type": "STRING"}},
+    "QUESTIONS": _query_items_schema("questions"),
+    "SEARCHES": _query_items_schema("search_terms"),
+    "ANSWERS": _query_items_schema("answers"),
+}
 
 class QueryGenerator:
     logger = setup_project_logger("QueryGenerator")
     
-    def __init__(self):
+    def __init__(self, stream_responses: bool = STREAM_RESPONSES, json_output: bool = JSON_OUTPUT,
+                 answer_mode: str = ANSWER_MODE):
         self.api_manager = APIManager()
+        self.stream_responses = stream_responses
+        self.json_output = json_output
+        self.answer_mode = answer_mode
+        self.reader = DataReader()
+        self.query_compiler = QueryCompiler()
+
+    def _call_llm(self, prompt_content: str, cached_prefix: str | None, section: str):
+        """
+        Calls the LLM for one step of the chain. In streaming mode the response is parsed as
+        it arrives and only the parsed queries are fed to the following prompts.
+        In JSON output mode the response is constrained to the section's schema and the queries
+        are passed on as a JSON array, so multi-line queries stay whole.
+        """
+        if self.json_output:
+            output = self.api_manager.call_llm_api(prompt_content, cached_prefix=cached_prefix,
+                                                   response_schema=JSON_RESPONSE_SCHEMAS[section])
+            if section == "QUERIES":
+                return json.dumps([str(query).strip() for query in self.reader.parse_json_content(output)], indent=2)
+            return output
+        
+        if not self.stream_responses:
+            return self.api_manager.call_llm_api(prompt_content, cached_prefix=cached_prefix)
+        
+        parser = self.api_manager.call_llm_api_stream(prompt_content, section, cached_prefix=cached_prefix)
+        if section == "QUERIES":
+            return "\n".join(parser.items)
+        return parser.text
 
     def send_chained_prompts_to_llm(
         self,
@@ -15,19 +68,23 @@ class QueryGenerator:
         prompt2_template: str,
         prompt3_template: str,
         prompt4_template: str,
-        delay_between_steps_seconds: int = 2
+        delay_between_steps_seconds: int = 2,
+        prompt_prefixes: tuple | None = None
     ) -> str | None:
         """
         Sends prompt1, then uses its output in prompt2, prompt3 and prompt4.
         Includes delays and retries for each step.
+        prompt_prefixes holds the shared per-collection prefix of each prompt, which is
+        sent as cached context where the backend supports it.
         """
         self.logger.info("Starting chained LLM calls.")
+        prefix1, prefix2, prefix3, prefix4 = prompt_prefixes or (None, None, None, None)
         
         # --- Step 1: Call with prompt1_template ---
         self.logger.info("Calling LLM with Prompt 1: Queries Generation.")
         output_prompt1 = None
         try:
-            output_prompt1 = self.api_manager.call_llm_api(prompt1_template)
+            output_prompt1 = self._call_llm(prompt1_template, prefix1, "QUERIES")
             if not output_prompt1:
                 self.logger.error("Prompt 1 call failed or returned no text.")
                 return None
@@ -46,7 +103,7 @@ class QueryGenerator:
         prompt2_content = prompt2_template.replace("QUERIES", output_prompt1)
         output_prompt2 = None
         try:
-            output_prompt2 = self.api_manager.call_llm_api(prompt2_content)
+            output_prompt2 = self._call_llm(prompt2_content, prefix2, "QUESTIONS")
             if not output_prompt2:
                 self.logger.error("Prompt 2 call failed or returned no text.")
                 return None
@@ -65,7 +122,7 @@ class QueryGenerator:
         prompt3_content = prompt3_template.replace("QUERIES", output_prompt1)
         output_prompt3 = None
         try:
-            output_prompt3 = self.api_manager.call_llm_api(prompt3_content)
+            output_prompt3 = self._call_llm(prompt3_content, prefix3, "SEARCHES")
             if not output_prompt3:
                 self.logger.error("Prompt 3 call failed or returned no text.")
                 return None
@@ -77,12 +134,17 @@ class QueryGenerator:
             self.logger.critical(f"An unexpected error occurred during Prompt 3 call: {e}", exc_info=True)
             return None
         
+        if self.answer_mode == "execute":
+            # Answers are rendered from the validated queries' results by DataCleaner
+            self.logger.info("Chained LLM calls completed successfully, skipping Prompt 4 in execute answer mode.")
+            return output_prompt1, output_prompt2, output_prompt3, ""
+        
         # --- Step 4: Call with prompt4_template, integrating output_prompt1 ---
         self.logger.info("Calling LLM with Prompt 4: Answer Generation.")
         prompt4_content = prompt4_template.replace("QUERIES", output_prompt1)
         output_prompt4 = None
         try:
-            output_prompt4 = self.api_manager.call_llm_api(prompt4_content)
+            output_prompt4 = self._call_llm(prompt4_content, prefix4, "ANSWERS")
             if not output_prompt4:
                 self.logger.error("Prompt 4 call failed or returned no text.")
                 return None
@@ -95,4 +157,65 @@ class QueryGenerator:
             return None
 
         self.logger.info("Chained LLM calls completed successfully.")
-        return output_prompt1, output_prompt2, output_prompt3, output_prompt4
\ No newline at end of file
+        return output_prompt1, output_prompt2, output_prompt3, output_prompt4
+
+    def generate_prompt_set_output(self, prompt_set: dict, delay_between_steps_seconds: int = 2) -> str | None:
+        """
+        Runs the chained prompts of one prompt set from PromptGenerator.generate_prompts and
+        returns the combined output to be written as its prompt result, or None if a step failed.
+        """
+        prompt_prefixes = (prompt_set.get("prefix1"), prompt_set.get("prefix2"),
+                           prompt_set.get("prefix3"), prompt_set.get("prefix4"))
+        outputs = self.send_chained_prompts_to_llm(
+            prompt_set["prompt1"], prompt_set["prompt2"], prompt_set["prompt3"], prompt_set["prompt4"],
+            delay_between_steps_seconds=delay_between_steps_seconds, # Adjust delay as needed
+            prompt_prefixes=prompt_prefixes
+        )
+        # The answers output is empty when answers are derived from the queries' results
+        if not outputs or not all(outputs[:3]) or (self.answer_mode != "execute" and not outputs[3]):
+            return None
+        
+        output_prompt1, output_prompt2, output_prompt3, output_prompt4 = outputs
+        if self.json_output:
+            return self.build_json_output(output_prompt1, output_prompt2, output_prompt3, output_prompt4)
+        return f'''QUERIES:\n{output_prompt1}\nQUESTIONS:\n{output_prompt2}\nSEARCHES:\n{output_prompt3}\nANSWERS:\n{output_prompt4}'''
+
+    def _query_key(self, query) -> str:
+        """Matches a query echoed back by a later prompt regardless of its formatting."""
+        try:
+            return self.query_compiler.compile(str(query)).key
+        except QueryCompileError:
+            return "".join(str(query).split())
+
+    def build_json_output(self, output_prompt1: str, output_prompt2: str, output_prompt3: str, output_prompt4: str) -> str:
+        """
+        Combines the JSON outputs of the chained prompts into a single document holding each
+        query with its questions, search terms and answers. Items are matched to the queries of
+        prompt 1 by their canonical query, or by position when the model rewrote a query.
+        """
+        query_list = [str(query) for query in self.reader.parse_json_content(output_prompt1)]
+        keys = [self._query_key(query) for query in query_list]
+        query_fields = [{} for _ in query_list]
+        for output, field in ((output_prompt2, "questions"), (output_prompt3, "search_terms"), (output_prompt4, "answers")):
+            if not output:
+                continue
+            items = [item for item in self.reader.parse_json_content(output) if isinstance(item, dict)]
+            by_key = {}
+            for item in items:
+                by_key.setdefault(self._query_key(item.get("query", "")), item)
+            for index, key in enumerate(keys):
+                item = by_key.get(key)
+                if item is None and len(items) == len(query_list):
+                    item = items[index]
+                if item is not None:
+                    query_fields[index][field] = [str(value).strip() for value in item.get(field, [])]
+        
+        queries = []
+        for query, fields in zip(query_list, query_fields):
+            queries.append({
+                "query": query,
+                "questions": fields.get("questions", []),
+                "search_terms": fields.get("search_terms", []),
+                "answers": fields.get("answers", []),
+            })
+        return json.dumps({"queries": queries}, indent=2)
@@ -0,0 +1,188 @@
+import json
+from config import QUERY_PROFILES_DIR, LOW_SELECTIVITY_RATIO, LOW_SELECTIVITY_MIN_DOCS
+from project_logger import setup_project_logger
+
+INDEX_SCAN_STAGES = {"IXSCAN", "IDHACK", "COUNT_SCAN", "DISTINCT_SCAN", "EXPRESS_IXSCAN", "EXPRESS_CLUSTERED_IXSCAN"}
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte", "$ne", "$nin", "$regex", "$exists"}
+
+class QueryProfiler:
+    """
+    Collects explain plans for validated queries, classifies their cost (index or collection
+    scan, documents examined against returned, blocking sorts, $lookup fan-out) and writes a
+    per-collection report with suggested indexes.
+    """
+    logger = setup_project_logger("QueryProfiler")
+
+    def __init__(self, db_manager):
+        QUERY_PROFILES_DIR.mkdir(parents=True, exist_ok=True)
+        self.db_manager = db_manager
+        # Collection name -> {query: profile}
+        self.profiles = {}
+
+    def _find_stages(self, node, stages: list):
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            for value in node.values():
+                self._find_stages(value, stages)
+        elif isinstance(node, list):
+            for value in node:
+                self._find_stages(value, stages)
+        return stages
+
+    def _winning_plans(self, node, plans: list):
+        """Collects the winning plans of an explain output (one per $cursor or shard), skipping rejected plans."""
+        if isinstance(node, dict):
+            if "winningPlan" in node:
+                plans.append(node["winningPlan"])
+            for key, value in node.items():
+                if key not in ("winningPlan", "rejectedPlans", "allPlansExecution"):
+                    self._winning_plans(value, plans)
+        elif isinstance(node, list):
+            for value in node:
+                self._winning_plans(value, plans)
+        return plans
+
+    def _find_key(self, node, key: str):
+        if isinstance(node, dict):
+            if key in node:
+                return node[key]
+            values = node.values()
+        elif isinstance(node, list):
+            values = node
+        else:
+            return None
+        for value in values:
+            found = self._find_key(value, key)
+            if found is not None:
+                return found
+        return None
+
+    def _lookup_stats(self, explain: dict):
+        """Returns the documents examined and collection scans of each $lookup stage."""
+        lookups = []
+        for stage in explain.get("stages", []):
+            if isinstance(stage, dict) and "$lookup" in stage:
+                lookups.append({"from": stage["$lookup"].get("from"),
+                                "docs_examined": stage.get("totalDocsExamined", 0),
+                                "returned": stage.get("nReturned", 0),
+                                "collection_scans": stage.get("collectionScans", 0)})
+        return lookups
+
+    def _classify(self, explain: dict):
+        # Rejected plans may sort or scan although the plan that runs does not
+        plans = self._winning_plans(explain, [])
+        if not plans:
+            plans = [(self._find_key(explain, "executionStats") or {}).get("executionStages", {})]
+        stages = self._find_stages(plans, [])
+        if "COLLSCAN" in stages:
+            plan = "COLLSCAN"
+        elif INDEX_SCAN_STAGES.intersection(stages):
+            plan = "IXSCAN"
+        else:
+            plan = stages[0] if stages else "UNKNOWN"
+
+        execution_stats = self._find_key(explain, "executionStats") or {}
+        docs_examined = execution_stats.get("totalDocsExamined", 0)
+        returned = execution_stats.get("nReturned", 0)
+        lookups = self._lookup_stats(explain)
+
+        flags = []
+        if plan == "COLLSCAN":
+            flags.append("collscan")
+        if "SORT" in stages:
+            flags.append("blocking_sort")
+        if docs_examined >= LOW_SELECTIVITY_MIN_DOCS and docs_examined > LOW_SELECTIVITY_RATIO * max(returned, 1):
+            flags.append("low_selectivity")
+        if any(lookup["collection_scans"] for lookup in lookups):
+            flags.append("lookup_collscan")
+        return {"plan": plan, "docs_examined": docs_examined, "returned": returned,
+                "lookups": lookups, "flags": flags}
+
+    def _suggest_index(self, compiled_query):
+        """
+        Suggests an index for a query following the equality, sort, range order, or returns
+        None if the query has no usable filter or sort.
+        """
+        query_filter, sort = compiled_query.filter, None
+        if compiled_query.method == "aggregate":
+            query_filter = None
+            for stage in compiled_query.pipeline:
+                if not isinstance(stage, dict):
+                    break
+                if "$match" in stage and query_filter is None:
+                    query_filter = stage["$match"]
+                elif "$sort" in stage and sort is None:
+                    sort = stage["$sort"]
+                elif not {"$match", "$sort", "$limit", "$skip"}.intersection(stage):
+                    break
+        for name, args in compiled_query.modifiers:
+            if name == "sort" and args:
+                sort = args[0]
+
+        equality, ranges = [], []
+        for field, condition in (query_filter or {}).items() if isinstance(query_filter, dict) else []:
+            if field.startswith("$"):
+                continue
+            if isinstance(condition, dict) and RANGE_OPERATORS.intersection(condition):
+                ranges.append(field)
+            else:
+                equality.append(field)
+        if isinstance(sort, dict):
+            sort_keys = [(field, direction) for field, direction in sort.items()]
+        elif isinstance(sort, list):
+            sort_keys = [tuple(item) for item in sort if isinstance(item, (list, tuple)) and len(item) == 2]
+        else:
+            sort_keys = []
+
+        keys = [(field, 1) for field in equality]
+        keys += [(field, direction) for field, direction in sort_keys if field not in equality]
+        keys += [(field, 1) for field in ranges if field not in equality and field not in dict(sort_keys)]
+        return keys or None
+
+    def profile(self, collection_name: str, query: str, mapped_query: str):
+        """
+        Explains a validated query and records its profile for the collection report.
+
+        Returns:
+            dict | None: The profile, or None if the query could not be explained.
+        """
+        compiled_query, explain = self.db_manager.explain_query(mapped_query)
+        if explain is None:
+            return None
+        profile = self._classify(explain)
+        if {"collscan", "blocking_sort", "low_selectivity"}.intersection(profile["flags"]):
+            profile["suggested_index"] = self._suggest_index(compiled_query)
+        profile["collection"] = compiled_query.collection
+        self.profiles.setdefault(collection_name, {})[query] = profile
+        return profile
+
+    def write_reports(self):
+        """Writes a JSON report per collection listing expensive queries and suggested indexes."""
+        for collection_name, profiles in self.profiles.items():
+            suggestions = {}
+            for query, profile in profiles.items():
+                if profile.get("suggested_index"):
+                    key = json.dumps([profile["collection"], profile["suggested_index"]])
+                    suggestion = suggestions.setdefault(key, {"collection": profile["collection"],
+                                                              "keys": profile["suggested_index"],
+                                                              "queries": 0})
+                    suggestion["queries"] += 1
+
+            expensive = {query: profile for query, profile in profiles.items() if profile["flags"]}
+            report = {
+                "collection": collection_name,
+                "queries_profiled": len(profiles),
+                "plans": {plan: sum(1 for p in profiles.values() if p["plan"] == plan)
+                          for plan in sorted({p["plan"] for p in profiles.values()})},
+                "suggested_indexes": sorted(suggestions.values(), key=lambda s: -s["queries"]),
+                "expensive_queries": expensive,
+            }
+            report_file = QUERY_PROFILES_DIR / f"{collection_name}_query_profile.json"
+            try:
+                with open(report_file, 'w') as file:
+                    json.dump(report, file, indent=2, default=str)
+                self.logger.info(f"Query profile for {collection_name} written to {report_file} "
+                                 f"({len(expensive)} of {len(profiles)} queries flagged)")
+            except Exception as e:
+                self.logger.error(f"Failed to write query profile {report_file}: {str(e)}")
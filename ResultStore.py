@@ -0,0 +1,132 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from config import RESULT_STORE_FILE, RESULT_STORE_MMAP_BYTES
+from project_logger import setup_project_logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    section TEXT NOT NULL,
+    subsection TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    size INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    content BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_key ON results (collection, section, subsection, id);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+"""
+
+class ResultStore:
+    """
+    Append-only store of prompt results in a single SQLite file, keyed by collection, section,
+    subsection and run. Results are zlib-compressed, each write adds a row and the latest row of
+    a key is its current result. The database runs in WAL mode with memory-mapped reads, so the
+    worker threads and JobWorker processes can write concurrently while the cleaner reads.
+    """
+    logger = setup_project_logger("ResultStore")
+
+    def __init__(self, path: Path = RESULT_STORE_FILE):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # sqlite3 connections cannot be shared between threads
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={int(RESULT_STORE_MMAP_BYTES)}")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def result_name(result) -> str:
+        """The file name of a result in the file-per-result layout, e.g. "cars_1_12.txt"."""
+        return f"{result['collection']}_{result['section']}_{result['subsection']}.txt"
+
+    def append(self, collection: str, section: str, subsection: str, content: str, run_id: str = "") -> int:
+        """
+        Stores a prompt result as the latest result of its key.
+
+        Returns:
+            int: The id of the stored result.
+        """
+        data = content.encode("utf-8")
+        cursor = self._connection().execute(
+            "INSERT INTO results (collection, section, subsection, run_id, created_at, size, content_hash, content) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (collection, section, subsection, run_id, time.time(), len(data),
+             hashlib.sha256(data).hexdigest(), zlib.compress(data)))
+        return cursor.lastrowid
+
+    def latest(self, collections: list | None = None, run_id: str | None = None) -> list:
+        """
+        Returns the metadata of the latest result of each key, without the content, optionally
+        only for the given collections or for results written by a run.
+        """
+        query = ("SELECT r.id, r.collection, r.section, r.subsection, r.run_id, r.created_at, r.size, r.content_hash "
+                 "FROM results r JOIN (SELECT MAX(id) AS id FROM results GROUP BY collection, section, subsection) l "
+                 "ON r.id = l.id")
+        conditions, params = [], []
+        if collections:
+            conditions.append(f"r.collection IN ({', '.join('?' * len(collections))})")
+            params += list(collections)
+        if run_id is not None:
+            conditions.append("r.run_id = ?")
+            params.append(run_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        rows = self._connection().execute(query + " ORDER BY r.collection, r.section, r.subsection", params)
+        return [dict(row) for row in rows]
+
+    def read(self, result_id: int) -> str:
+        row = self._connection().execute("SELECT content FROM results WHERE id = ?", (result_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No prompt result with id {result_id}")
+        return zlib.decompress(row["content"]).decode("utf-8")
+
+    def export(self, directory: Path, collections: list | None = None) -> int:
+        """Writes the latest result of each key as a text file, in the layout of PROMPT_RESULT_DIR."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        results = self.latest(collections)
+        for result in results:
+            with open(directory / self.result_name(result), 'w') as file:
+                file.write(self.read(result["id"]))
+        self.logger.info(f"Exported {len(results)} prompt results to {directory}")
+        return len(results)
+
+    def import_files(self, directory: Path, run_id: str = "import", only_missing: bool = False) -> int:
+        """
+        Stores the <collection>_<section>_<subsection>.txt files of a directory, skipping files
+        whose content is already the latest result of their key. With only_missing, files are
+        only stored for keys that have no result yet, so older files never replace newer results.
+        """
+        current = {self.result_name(result): result["content_hash"] for result in self.latest()}
+        imported = 0
+        for path in sorted(Path(directory).glob("*.txt")):
+            parts = path.stem.split("_")
+            if len(parts) < 3:
+                self.logger.warning(f"Skipping {path.name}, not a prompt result file name.")
+                continue
+            if only_missing and path.name in current:
+                continue
+            content = path.read_text()
+            if current.get(path.name) == hashlib.sha256(content.encode("utf-8")).hexdigest():
+                continue
+            self.append("_".join(parts[:-2]), parts[-2], parts[-1], content, run_id)
+            imported += 1
+        if imported or not only_missing:
+            self.logger.info(f"Imported {imported} prompt results from {directory}")
+        return imported
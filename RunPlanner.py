@@ -0,0 +1,238 @@
+import heapq
+import json
+import math
+import re
+import statistics
+from collections import defaultdict
+from config import (
+    MAX_WORKERS, LLM_REQUESTS_PER_MINUTE, ANSWER_MODE, CONTEXT_CACHING, RESULT_STORE, RESULT_STORE_FILE,
+    LLM_METRICS_FILE, PLAN_CHARS_PER_TOKEN, PLAN_DEFAULT_OUTPUT_TOKENS, PLAN_DEFAULT_LATENCY_SECONDS)
+from project_logger import setup_project_logger
+from PromptGenerator import PromptGenerator, query_type_id
+
+class RunPlanner:
+    """
+    Dry run of a generation run: renders every prompt set from PromptGenerator.generate_prompts
+    without calling the model, estimates the tokens of each call of the chain and simulates the
+    worker pool to estimate the run's duration. Only distributed runs share the per-minute request
+    budget (see JobWorker); the local worker pool of Orchestrator sends its calls unthrottled.
+
+    Output tokens are estimated from the stored result of the same collection and query type,
+    then from the collection's other stored results, then from the call metrics APIManager
+    records in LLM_METRICS_FILE, and finally from PLAN_DEFAULT_OUTPUT_TOKENS. Call latency is
+    fitted to the output tokens of the recorded calls. Retries are not simulated.
+    """
+    logger = setup_project_logger("RunPlanner")
+
+    def __init__(self, max_workers: int = MAX_WORKERS, requests_per_minute: int | None = LLM_REQUESTS_PER_MINUTE,
+                 delay_between_steps_seconds: float = 2, answer_mode: str = ANSWER_MODE,
+                 context_caching: bool = CONTEXT_CACHING, distributed: bool = False):
+        self.max_workers = max_workers
+        self.distributed = distributed
+        self.requests_per_minute = requests_per_minute if distributed else None
+        self.delay_between_steps_seconds = delay_between_steps_seconds
+        # Prompt 4 is skipped when answers are rendered from the query results
+        self.steps = 3 if answer_mode == "execute" else 4
+        self.context_caching = context_caching
+        self.prompt_generator = PromptGenerator()
+
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        """
+        Approximates the token count of a text: words count one token per started
+        PLAN_CHARS_PER_TOKEN characters and every punctuation character counts as one token.
+        """
+        words = re.findall(r"\w+", text)
+        return sum(math.ceil(len(word) / PLAN_CHARS_PER_TOKEN) for word in words) + len(re.findall(r"[^\w\s]", text))
+
+    def _load_call_metrics(self):
+        if not LLM_METRICS_FILE.exists():
+            return []
+        metrics = []
+        with open(LLM_METRICS_FILE) as file:
+            for line in file:
+                try:
+                    metrics.append(json.loads(line))
+                except ValueError:
+                    continue
+        return metrics
+
+    def _past_result_tokens(self):
+        """Returns the output tokens of the latest stored result by result name, e.g. "cars_1_12.txt"."""
+        if not RESULT_STORE or not RESULT_STORE_FILE.exists():
+            return {}
+        from ResultStore import ResultStore
+        return {ResultStore.result_name(result): math.ceil(result["size"] / PLAN_CHARS_PER_TOKEN)
+                for result in ResultStore().latest()}
+
+    def _latency_model(self, metrics: list):
+        """
+        Fits latency = base + per_token * output tokens to the recorded calls.
+
+        Returns:
+            tuple: (base seconds, seconds per output token)
+        """
+        samples = [(m["output_tokens"], m["latency"]) for m in metrics
+                   if m.get("output_tokens") is not None and m.get("latency") is not None]
+        if len(samples) >= 5 and len({tokens for tokens, _ in samples}) > 1:
+            per_token, base = statistics.linear_regression([float(t) for t, _ in samples],
+                                                           [float(l) for _, l in samples])
+            if per_token >= 0 and base >= 0:
+                return base, per_token
+        latencies = [m["latency"] for m in metrics if m.get("latency") is not None]
+        if latencies:
+            return statistics.median(latencies), 0.0
+        return PLAN_DEFAULT_LATENCY_SECONDS, 0.0
+
+    def _call_output_tokens(self, metrics: list):
+        tokens = [m["output_tokens"] if m.get("output_tokens") is not None
+                  else math.ceil(m.get("output_chars", 0) / PLAN_CHARS_PER_TOKEN) for m in metrics]
+        return statistics.mean(tokens) if tokens else PLAN_DEFAULT_OUTPUT_TOKENS
+
+    def _plan_calls(self, prompt_set: dict, output_tokens_per_call: float, latency_model: tuple, cached_prefixes: set):
+        """
+        Returns the estimated calls of a prompt set's chain, in order. cached_prefixes holds the
+        prefixes of earlier calls; the first call of a prefix creates its cache and reads none.
+        """
+        base_latency, latency_per_token = latency_model
+        calls = []
+        for step in range(1, self.steps + 1):
+            prompt = prompt_set[f"prompt{step}"]
+            prefix = prompt_set.get(f"prefix{step}") or ""
+            input_tokens = self.count_tokens(prompt)
+            # Prompts 2 to 4 receive the queries generated by prompt 1
+            if step > 1 and "QUERIES" in prompt:
+                input_tokens += output_tokens_per_call
+            cached_tokens = 0
+            if self.context_caching and prefix:
+                if prefix in cached_prefixes:
+                    cached_tokens = self.count_tokens(prefix)
+                cached_prefixes.add(prefix)
+            calls.append({"input_tokens": input_tokens, "cached_tokens": cached_tokens,
+                          "output_tokens": output_tokens_per_call,
+                          "latency": base_latency + latency_per_token * output_tokens_per_call})
+        return calls
+
+    def _take_rate_slot(self, start: float, windows: dict):
+        """Returns when a call ready at start may be sent, taking a slot of its minute window like DBManager.acquire_rate_slot."""
+        if not self.requests_per_minute:
+            return start
+        window = int(start // 60)
+        while windows[window] >= self.requests_per_minute:
+            window += 1
+            start = window * 60.0
+        windows[window] += 1
+        return start
+
+    def _simulate(self, prompt_set_calls: list):
+        """
+        Simulates the worker pool: each worker runs the chain of one prompt set at a time, with
+        the delay QueryGenerator waits after prompts 1 and 2, and in distributed runs every call
+        waits for a slot of the per-minute budget.
+
+        Returns:
+            float: The estimated duration in seconds.
+        """
+        windows = defaultdict(int)
+        # (time the worker is ready, prompt set index, call index)
+        ready = [(0.0, index, 0) for index in range(min(self.max_workers, len(prompt_set_calls)))]
+        heapq.heapify(ready)
+        next_set = len(ready)
+        duration = 0.0
+        while ready:
+            ready_at, set_index, call_index = heapq.heappop(ready)
+            calls = prompt_set_calls[set_index]
+            finished_at = self._take_rate_slot(ready_at, windows) + calls[call_index]["latency"]
+            duration = max(duration, finished_at)
+            if call_index + 1 < len(calls):
+                delay = self.delay_between_steps_seconds if call_index < 2 else 0
+                heapq.heappush(ready, (finished_at + delay, set_index, call_index + 1))
+            elif next_set < len(prompt_set_calls):
+                heapq.heappush(ready, (finished_at, next_set, 0))
+                next_set += 1
+        return duration
+
+    def plan(self, collections: list | None = None, query_types: list | None = None):
+        """
+        Estimates a generation run over the given collections and query types.
+
+        Returns:
+            dict: Totals for the run and per collection, with collections ordered by token volume.
+        """
+        prompt_sets = self.prompt_generator.generate_prompts(collections, query_types)
+        metrics = self._load_call_metrics()
+        past_tokens = self._past_result_tokens()
+        latency_model = self._latency_model(metrics)
+        default_output_tokens = self._call_output_tokens(metrics)
+
+        collection_past_tokens = defaultdict(list)
+        for name, tokens in past_tokens.items():
+            collection_past_tokens["_".join(name.split("_")[:-2])].append(tokens)
+
+        prompt_set_calls = []
+        by_collection = defaultdict(lambda: {"prompt_sets": 0, "requests": 0, "input_tokens": 0,
+                                             "cached_tokens": 0, "output_tokens": 0, "call_seconds": 0.0})
+        sources = defaultdict(int)
+        cached_prefixes = set()
+        for prompt_set in prompt_sets:
+            collection_name = prompt_set["collection"]
+            query_type = prompt_set["query_type"]
+            name = f'{collection_name}_{query_type_id(query_type["section"], query_type["subsection"])}.txt'
+            if name in past_tokens:
+                output_tokens, source = past_tokens[name] / self.steps, "past result"
+            elif collection_past_tokens.get(collection_name):
+                output_tokens, source = statistics.mean(collection_past_tokens[collection_name]) / self.steps, "collection results"
+            else:
+                output_tokens, source = default_output_tokens, "call metrics" if metrics else "default"
+            sources[source] += 1
+
+            calls = self._plan_calls(prompt_set, output_tokens, latency_model, cached_prefixes)
+            prompt_set_calls.append(calls)
+            totals = by_collection[collection_name]
+            totals["prompt_sets"] += 1
+            totals["requests"] += len(calls)
+            for key in ("input_tokens", "cached_tokens", "output_tokens"):
+                totals[key] += round(sum(call[key] for call in calls))
+            totals["call_seconds"] += sum(call["latency"] for call in calls)
+
+        # Each distinct prefix is registered once as cached context
+        cache_creations = len(cached_prefixes)
+        report = {
+            "prompt_sets": len(prompt_sets),
+            "requests": sum(totals["requests"] for totals in by_collection.values()),
+            "cache_creations": cache_creations,
+            "input_tokens": sum(totals["input_tokens"] for totals in by_collection.values()),
+            "cached_tokens": sum(totals["cached_tokens"] for totals in by_collection.values()),
+            "output_tokens": sum(totals["output_tokens"] for totals in by_collection.values()),
+            "duration_seconds": round(self._simulate(prompt_set_calls), 1),
+            "max_workers": self.max_workers,
+            "distributed": self.distributed,
+            "requests_per_minute": self.requests_per_minute,
+            "output_estimate_sources": dict(sources),
+            "collections": dict(sorted(by_collection.items(),
+                                       key=lambda item: -(item[1]["input_tokens"] + item[1]["output_tokens"]))),
+        }
+        self.logger.info(f"Planned {report['prompt_sets']} prompt sets: {report['requests']} requests, "
+                         f"{report['input_tokens']} input tokens ({report['cached_tokens']} cached), "
+                         f"{report['output_tokens']} output tokens, about {report['duration_seconds'] / 3600:.2f} hours "
+                         f"with {self.max_workers} workers.")
+        return report
+
+    def print_report(self, report: dict):
+        total_tokens = (report["input_tokens"] + report["output_tokens"]) or 1
+        print(f"Prompt sets:      {report['prompt_sets']}")
+        print(f"Requests:         {report['requests']} (+{report['cache_creations']} context cache creations)")
+        print(f"Input tokens:     {report['input_tokens']} ({report['cached_tokens']} from cached context)")
+        print(f"Output tokens:    {report['output_tokens']}")
+        print(f"Duration:         {report['duration_seconds'] / 3600:.2f} h with {report['max_workers']} "
+              f"{'distributed' if report['distributed'] else 'local'} workers, "
+              f"{report['requests_per_minute'] or 'unlimited'} requests/minute")
+        print(f"Output estimates: {report['output_estimate_sources']}")
+        if not report["collections"]:
+            return
+        width = max(len("collection"), *(len(name) for name in report["collections"]))
+        columns = ("prompt_sets", "requests", "input_tokens", "output_tokens")
+        print("collection".ljust(width) + "".join(f"{column:>15}" for column in columns) + f"{'share':>8}")
+        for name, totals in report["collections"].items():
+            share = (totals["input_tokens"] + totals["output_tokens"]) / total_tokens
+            print(name.ljust(width) + "".join(f"{totals[column]:>15}" for column in columns) + f"{share:>8.1%}")
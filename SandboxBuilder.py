@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta, timezone
+from project_logger import setup_project_logger
+from config import (
+    DATABASE, SANDBOX_DATABASE, SANDBOX_SAMPLE_SIZE, SANDBOX_STRATIFY_FIELDS,
+    SANDBOX_MAX_STRATA, SANDBOX_REFRESH_HOURS)
+
+# Collection in the sandbox recording when each sampled collection was built
+SANDBOX_META_COLLECTION = "_sandbox_meta"
+INSERT_BATCH_SIZE = 1000
+
+class SandboxBuilder:
+    """
+    Builds a sandbox database holding a stratified sample of every collection described in
+    COLLECTION_INFO_DIR, with the same indexes as the source collection, so generated queries
+    can be validated without the cost of production-size data.
+    """
+    logger = setup_project_logger("SandboxBuilder")
+
+    def __init__(self, db_manager, sample_size: int = SANDBOX_SAMPLE_SIZE, refresh_hours: float = SANDBOX_REFRESH_HOURS):
+        self.db_manager = db_manager
+        self.sample_size = sample_size
+        self.refresh_hours = refresh_hours
+        self.source_db = db_manager.client[DATABASE]
+        self.sandbox_db = db_manager.client[SANDBOX_DATABASE]
+
+    def _is_fresh(self, collection_name: str):
+        meta = self.sandbox_db[SANDBOX_META_COLLECTION].find_one({"_id": collection_name})
+        if meta is None or meta.get("sample_size") != self.sample_size:
+            return False
+        built_at = meta["built_at"]
+        if built_at.tzinfo is None:
+            built_at = built_at.replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) - built_at < timedelta(hours=self.refresh_hours)
+
+    def _sample_pipelines(self, collection_name: str):
+        """
+        Returns the aggregation pipelines drawing the sample. Without a stratify field this is a
+        single $sample; otherwise each of the largest strata is sampled in proportion to its size.
+        """
+        field = SANDBOX_STRATIFY_FIELDS.get(collection_name)
+        if not field:
+            return [[{"$sample": {"size": self.sample_size}}]]
+
+        source = self.source_db[collection_name]
+        strata = list(source.aggregate([{"$sortByCount": f"${field}"}, {"$limit": SANDBOX_MAX_STRATA}],
+                                       allowDiskUse=True))
+        total = source.estimated_document_count() or 1
+        pipelines = []
+        for stratum in strata:
+            size = max(1, round(self.sample_size * stratum["count"] / total))
+            pipelines.append([{"$match": {field: stratum["_id"]}}, {"$sample": {"size": size}}])
+
+        # Everything outside the largest strata is sampled together
+        remaining = total - sum(stratum["count"] for stratum in strata)
+        if remaining > 0:
+            size = max(1, round(self.sample_size * remaining / total))
+            pipelines.append([{"$match": {field: {"$nin": [stratum["_id"] for stratum in strata]}}},
+                              {"$sample": {"size": size}}])
+        return pipelines
+
+    def _copy_indexes(self, collection_name: str):
+        specs = []
+        for index in self.source_db[collection_name].list_indexes():
+            if index["name"] == "_id_":
+                continue
+            specs.append({key: value for key, value in index.items() if key not in ("v", "ns")})
+        if specs:
+            self.sandbox_db.command("createIndexes", collection_name, indexes=specs)
+        return len(specs)
+
+    def _build_collection(self, collection_name: str):
+        self.sandbox_db.drop_collection(collection_name)
+        target = self.sandbox_db[collection_name]
+        index_count = self._copy_indexes(collection_name)
+
+        copied = 0
+        seen_ids = set()
+        for pipeline in self._sample_pipelines(collection_name):
+            batch = []
+            for document in self.source_db[collection_name].aggregate(pipeline, allowDiskUse=True):
+                # $sample may return the same document more than once
+                if document["_id"] in seen_ids:
+                    continue
+                seen_ids.add(document["_id"])
+                batch.append(document)
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    target.insert_many(batch, ordered=False)
+                    copied += len(batch)
+                    batch = []
+            if batch:
+                target.insert_many(batch, ordered=False)
+                copied += len(batch)
+
+        self.sandbox_db[SANDBOX_META_COLLECTION].replace_one(
+            {"_id": collection_name},
+            {"_id": collection_name, "sample_size": self.sample_size, "documents": copied,
+             "built_at": datetime.now(timezone.utc)},
+            upsert=True)
+        self.logger.info(f"Sampled {copied} documents and {index_count} indexes of {collection_name} into {SANDBOX_DATABASE}")
+
+    def build(self, collections_info: list, force: bool = False):
+        """
+        Samples the collections of the given collection_info files into the sandbox database.
+        Collections sampled within the refresh interval are reused unless force is set.
+
+        Returns:
+            str: The name of the sandbox database.
+        """
+        source_collections = set(self.source_db.list_collection_names())
+        for collection_info in collections_info:
+            # Queries use the mapped names, which may include the collection's real name
+            names = {collection_info["name"]} | {str(value) for value in (collection_info.get("mappings") or {}).values()}
+            for collection_name in sorted(names & source_collections):
+                if not force and self._is_fresh(collection_name):
+                    self.logger.info(f"Sandbox copy of {collection_name} is up to date.")
+                    continue
+                try:
+                    self._build_collection(collection_name)
+                except Exception as e:
+                    self.logger.error(f"Failed to sample {collection_name} into the sandbox: {e}")
+        return SANDBOX_DATABASE
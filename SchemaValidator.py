@@ -0,0 +1,242 @@
+import json
+from project_logger import setup_project_logger
+from config import STATIC_VALIDATION_STRICT
+
+QUERY_OPERATORS = {
+    "$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin",
+    "$and", "$or", "$nor", "$not",
+    "$exists", "$type",
+    "$expr", "$jsonSchema", "$mod", "$regex", "$options", "$text", "$search", "$language",
+    "$caseSensitive", "$diacriticSensitive", "$where", "$comment",
+    "$geoIntersects", "$geoWithin", "$near", "$nearSphere", "$geometry", "$maxDistance", "$minDistance",
+    "$box", "$center", "$centerSphere", "$polygon",
+    "$all", "$elemMatch", "$size",
+    "$bitsAllClear", "$bitsAllSet", "$bitsAnyClear", "$bitsAnySet",
+}
+
+PIPELINE_STAGES = {
+    "$addFields", "$bucket", "$bucketAuto", "$count", "$densify", "$facet", "$fill", "$geoNear",
+    "$graphLookup", "$group", "$limit", "$lookup", "$match", "$project", "$redact", "$replaceRoot",
+    "$replaceWith", "$sample", "$search", "$searchMeta", "$set", "$setWindowFields", "$skip", "$sort",
+    "$sortByCount", "$unionWith", "$unset", "$unwind",
+}
+
+# Stages after which the documents no longer have the collection's shape
+RESHAPING_STAGES = {
+    "$bucket", "$bucketAuto", "$count", "$facet", "$group", "$project", "$replaceRoot",
+    "$replaceWith", "$sortByCount", "$unionWith", "$graphLookup", "$setWindowFields",
+}
+
+# Declared types that may hold sub-fields which the schema does not list
+OPEN_TYPES = {"object", "dict", "json", "array", "list", "mixed", "any"}
+
+
+class SchemaValidator:
+    """
+    Statically checks compiled queries against the fields described by a collection's
+    collection_info (schema and mappings), so clearly invalid queries are rejected before they
+    are sent to MongoDB. Malformed queries are rejected. In strict mode top-level fields the schema
+    does not list are rejected as well; other unknown fields, and all of them when strict mode is
+    off, are only reported as warnings since schemas are often incomplete.
+    """
+    logger = setup_project_logger("SchemaValidator")
+
+    def __init__(self, collection_info: dict, strict: bool = STATIC_VALIDATION_STRICT):
+        self.strict = strict
+        self.collection_names = {collection_info["name"]}
+        self.fields = {}
+        self._add_schema_fields(self._load_schema(collection_info.get("schema")), "")
+        # Queries are checked after their aliases were replaced with the actual names
+        mappings = collection_info.get("mappings") or {}
+        for path, field_type in list(self.fields.items()):
+            mapped_path = path
+            for alias, field in mappings.items():
+                mapped_path = mapped_path.replace(str(alias), str(field))
+            if mapped_path != path:
+                self._add_path(mapped_path, field_type)
+        for alias, field in mappings.items():
+            self.collection_names.update({str(alias), str(field)})
+            self._add_path(str(field), self.fields.get(str(field)))
+        # Without a usable schema the field names cannot be checked
+        self.check_fields = len(self.fields) > 0
+        # Every document has an _id, whether or not the schema lists it
+        self.fields.setdefault("_id", "any")
+        if not self.check_fields:
+            self.logger.warning(f"No field paths found in schema of {collection_info['name']}, only operators are checked.")
+
+    def _load_schema(self, schema):
+        if isinstance(schema, str):
+            try:
+                return json.loads(schema)
+            except ValueError:
+                return None
+        return schema
+
+    def _add_path(self, path: str, field_type):
+        parts = path.split(".")
+        for i in range(1, len(parts)):
+            self.fields.setdefault(".".join(parts[:i]), "object")
+        self.fields[path] = field_type
+
+    def _add_schema_fields(self, schema, prefix: str):
+        if isinstance(schema, dict):
+            for key, value in schema.items():
+                path = f"{prefix}{key}"
+                if isinstance(value, dict) and not ("type" in value and len(value) <= 2):
+                    # Sub-documents with listed fields are closed; only their fields are accepted
+                    self._add_path(path, "document")
+                    self._add_schema_fields(value, f"{path}.")
+                elif isinstance(value, list) and value and isinstance(value[0], dict):
+                    self._add_path(path, "document")
+                    self._add_schema_fields(value[0], f"{path}.")
+                elif isinstance(value, dict):
+                    self._add_path(path, str(value["type"]).lower())
+                else:
+                    self._add_path(path, str(value).lower() if isinstance(value, str) else None)
+        elif isinstance(schema, list):
+            for item in schema:
+                if isinstance(item, str):
+                    self._add_path(f"{prefix}{item}", None)
+                else:
+                    self._add_schema_fields(item, prefix)
+
+    def _is_known_field(self, path: str, extra_fields=()):
+        if not self.check_fields:
+            return True
+        # Array positions (items.0.name) are not part of the schema
+        parts = [part for part in path.split(".") if not part.isdigit() and part != "$"]
+        path = ".".join(parts)
+        if path in self.fields or path in extra_fields or parts[0] in extra_fields:
+            return True
+        for i in range(len(parts) - 1, 0, -1):
+            field_type = self.fields.get(".".join(parts[:i]))
+            if field_type is not None and field_type in OPEN_TYPES:
+                return True
+        return False
+
+    def _report_unknown_field(self, path: str, message: str, reasons: list, warnings: list, extra_fields=()):
+        """Rejects a query on a top-level field the schema does not list in strict mode, otherwise warns."""
+        if self._is_known_field(path, extra_fields):
+            return
+        top_level = path.split(".")[0]
+        if self.strict and top_level not in self.fields and top_level not in extra_fields:
+            reasons.append(message)
+        else:
+            warnings.append(message)
+
+    def _check_filter(self, query_filter, reasons: list, warnings: list, extra_fields=(), prefix: str = ""):
+        if not isinstance(query_filter, dict):
+            reasons.append(f"Filter is not a document: {query_filter!r}")
+            return
+        for key, value in query_filter.items():
+            if key.startswith("$"):
+                if key not in QUERY_OPERATORS:
+                    reasons.append(f"Unknown query operator {key}")
+                elif key in ("$and", "$or", "$nor"):
+                    for clause in value if isinstance(value, list) else [value]:
+                        self._check_filter(clause, reasons, warnings, extra_fields, prefix)
+                continue
+            path = f"{prefix}{key}"
+            self._report_unknown_field(path, f"Unknown field '{path}'", reasons, warnings, extra_fields)
+            self._check_condition(path, value, reasons, warnings, extra_fields)
+
+    def _check_condition(self, path: str, condition, reasons: list, warnings: list, extra_fields):
+        if not isinstance(condition, dict) or not any(str(key).startswith("$") for key in condition):
+            return
+        for operator, value in condition.items():
+            if operator not in QUERY_OPERATORS:
+                reasons.append(f"Unknown query operator {operator} on '{path}'")
+            elif operator == "$elemMatch" and isinstance(value, dict):
+                if any(str(key).startswith("$") for key in value):
+                    self._check_condition(path, value, reasons, warnings, extra_fields)
+                else:
+                    self._check_filter(value, reasons, warnings, extra_fields, prefix=f"{path}.")
+            elif operator == "$not":
+                self._check_condition(path, value, reasons, warnings, extra_fields)
+
+    def _check_field_references(self, expression, reasons: list, warnings: list, extra_fields):
+        """Checks "$field" references inside an aggregation expression."""
+        if isinstance(expression, str):
+            if expression.startswith("$") and not expression.startswith("$$"):
+                self._report_unknown_field(expression[1:], f"Unknown field '{expression[1:]}' referenced",
+                                           reasons, warnings, extra_fields)
+        elif isinstance(expression, dict):
+            for value in expression.values():
+                self._check_field_references(value, reasons, warnings, extra_fields)
+        elif isinstance(expression, list):
+            for value in expression:
+                self._check_field_references(value, reasons, warnings, extra_fields)
+
+    def _check_pipeline(self, pipeline, reasons: list, warnings: list):
+        if not isinstance(pipeline, list):
+            reasons.append("Pipeline is not a list of stages")
+            return
+        added_fields = set()
+        for stage in pipeline:
+            if not isinstance(stage, dict) or len(stage) != 1:
+                reasons.append(f"Invalid pipeline stage: {stage!r}")
+                return
+            name, body = next(iter(stage.items()))
+            if name not in PIPELINE_STAGES:
+                reasons.append(f"Unknown pipeline stage {name}")
+                return
+            if name == "$match":
+                self._check_filter(body, reasons, warnings, added_fields)
+            elif name == "$sort" and isinstance(body, dict):
+                for key in body:
+                    self._report_unknown_field(key, f"Unknown sort field '{key}'", reasons, warnings, added_fields)
+            elif name == "$lookup" and isinstance(body, dict):
+                # The joined collection has its own schema
+                if isinstance(body.get("localField"), str):
+                    self._report_unknown_field(body["localField"], f"Unknown lookup field '{body['localField']}'",
+                                               reasons, warnings, added_fields)
+                if body.get("as"):
+                    added_fields.add(str(body["as"]))
+            elif name in ("$addFields", "$set") and isinstance(body, dict):
+                self._check_field_references(body, reasons, warnings, added_fields)
+                added_fields.update(body.keys())
+            elif name not in ("$limit", "$skip", "$sample", "$count", "$unset"):
+                self._check_field_references(body, reasons, warnings, added_fields)
+
+            if name in RESHAPING_STAGES:
+                # Later stages work on documents of a different shape
+                return
+
+    def check(self, compiled_query):
+        """
+        Statically checks a CompiledQuery.
+
+        Returns:
+            tuple: (reasons, warnings). reasons lists why the query is invalid and is empty if it
+            may be run; warnings lists fields the schema does not know that do not reject it.
+        """
+        reasons, warnings = [], []
+        if compiled_query.collection not in self.collection_names:
+            reasons.append(f"Unknown collection '{compiled_query.collection}'")
+
+        if compiled_query.method == "aggregate":
+            self._check_pipeline(compiled_query.pipeline, reasons, warnings)
+        elif compiled_query.filter is not None:
+            self._check_filter(compiled_query.filter, reasons, warnings)
+
+        projection = compiled_query.projection
+        if isinstance(projection, dict):
+            for key in projection:
+                if not key.startswith("$"):
+                    self._report_unknown_field(key, f"Unknown projected field '{key}'", reasons, warnings)
+
+        if compiled_query.method == "distinct" and compiled_query.args and isinstance(compiled_query.args[0], str):
+            self._report_unknown_field(compiled_query.args[0], f"Unknown distinct field '{compiled_query.args[0]}'",
+                                       reasons, warnings)
+
+        for name, args in compiled_query.modifiers:
+            if name == "sort" and args:
+                if isinstance(args[0], dict):
+                    keys = list(args[0].keys())
+                elif isinstance(args[0], str):
+                    keys = [args[0]]
+                else:
+                    keys = [item[0] for item in args[0] if isinstance(item, (list, tuple)) and item]
+                for key in keys:
+                    self._report_unknown_field(str(key), f"Unknown sort field '{key}'", reasons, warnings)
+        return reasons, warnings
@@ -0,0 +1,63 @@
+from config import STREAM_ABORT_AFTER_LINES
+
+# How a line belonging to each section of the chained prompt output is recognised
+SECTION_LINE_MARKERS = {
+    "QUERIES": lambda line: line.startswith("db."),
+    "QUESTIONS": lambda line: "Question" in line,
+    "SEARCHES": lambda line: "Search Term" in line,
+    "ANSWERS": lambda line: "Answer" in line,
+}
+
+class StreamParser:
+    """
+    Incrementally parses a streamed LLM response for one section of the chained prompt
+    output, collecting the lines that belong to the section as soon as they are complete.
+    """
+
+    def __init__(self, section: str, abort_after_lines: int = STREAM_ABORT_AFTER_LINES):
+        if section not in SECTION_LINE_MARKERS:
+            raise ValueError(f"Unknown section '{section}'.")
+        self.section = section
+        self.abort_after_lines = abort_after_lines
+        self._is_section_line = SECTION_LINE_MARKERS[section]
+        self._buffer = ""
+        self.chunks = []
+        self.items = []
+        self.lines_seen = 0
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    def _parse_line(self, line: str):
+        line = line.strip()
+        # Blank lines and markdown code fences carry no content
+        if not line or line.startswith("```"):
+            return
+        self.lines_seen += 1
+        if self._is_section_line(line):
+            self.items.append(line)
+
+    def feed(self, chunk: str):
+        """
+        Consume one chunk of the response.
+
+        Returns:
+            bool: False once the output clearly fails the expected format and the request
+            should be cancelled, True otherwise.
+        """
+        self.chunks.append(chunk)
+        self._buffer += chunk
+        *complete_lines, self._buffer = self._buffer.split("\n")
+        for line in complete_lines:
+            self._parse_line(line)
+        return self.is_well_formed()
+
+    def close(self):
+        """Parse the trailing line once the stream has ended."""
+        self._parse_line(self._buffer)
+        self._buffer = ""
+        return self.is_well_formed() and len(self.items) > 0
+
+    def is_well_formed(self):
+        return len(self.items) > 0 or self.lines_seen < self.abort_after_lines
@@ -1,14 +1,77 @@
 # app.py
+import argparse
 import time
-from config import DATA_DIR
+from config import DATA_DIR, PROMPT_RESULT_DIR, INCREMENTAL_CLEANING
 from Orchestrator import Orchestrator
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate, clean and collate NL2SQL question/query pairs. "
+                                                 "Without a command the full workflow runs.")
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument("-c", "--collection", action="append", dest="collections",
+                         help="Only process this collection (repeatable).")
+    filters.add_argument("-q", "--query-type", action="append", dest="query_types",
+                         help='Only process this query type, e.g. "1_12", or all of a section, e.g. "1" (repeatable).')
+    parser.set_defaults(collections=None, query_types=None, full=False, refresh_sandbox=False)
+
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("generate", parents=[filters], help="Generate prompt results with the LLM.")
+    clean = commands.add_parser("clean", parents=[filters], help="Validate and clean prompt results into CSV files.")
+    clean.add_argument("--full", action="store_true",
+                       help="Clean every prompt result again, including those unchanged since the last run.")
+    clean.add_argument("--refresh-sandbox", action="store_true",
+                       help="Sample the sandbox collections again even if they are up to date.")
+    commands.add_parser("collate", parents=[filters], help="Collate the CSV files into the Excel output.")
+    commands.add_parser("report", parents=[filters], help="Print counts of results, rows and errors per collection.")
+    enqueue = commands.add_parser("enqueue", parents=[filters],
+                                  help="Queue the prompt sets of a distributed run for JobWorker processes.")
+    enqueue.add_argument("run_id", help="Id of the distributed run.")
+    collect = commands.add_parser("collect",
+                                  help="Wait for the workers of a distributed run and store their prompt results.")
+    collect.add_argument("run_id", help="Id of the distributed run.")
+    plan = commands.add_parser("plan", parents=[filters],
+                               help="Estimate requests, tokens and duration of a generation run without calling the model.")
+    plan.add_argument("--workers", type=int, default=None, help="Concurrent prompt sets to simulate (default: MAX_WORKERS).")
+    plan.add_argument("--distributed", action="store_true",
+                      help="Simulate JobWorker nodes sharing the per-minute request budget instead of the local worker pool.")
+    plan.add_argument("--rpm", type=int, default=None,
+                      help="Requests per minute of a distributed run, 0 for unlimited (default: LLM_REQUESTS_PER_MINUTE).")
+    commands.add_parser("export-results", parents=[filters],
+                        help="Write the latest stored prompt results as one text file each to the prompt results directory.")
+    commands.add_parser("import-results", help="Store the text files of the prompt results directory in the result store.")
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
     # Ensure the directory exists
-    DATA_DIR.mkdir(exist_ok=True)    
-    orchestrator = Orchestrator()
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    orchestrator = Orchestrator(incremental_cleaning=INCREMENTAL_CLEANING and not args.full, refresh_sandbox=args.refresh_sandbox)
     start_time = time.time()
-    orchestrator.run_workflow()
+    if args.command == "report":
+        from DataCollator import DataCollator
+        DataCollator().report(args.collections, args.query_types)
+    elif args.command == "enqueue":
+        orchestrator.enqueue_generation_jobs(args.run_id, args.collections, args.query_types)
+    elif args.command == "collect":
+        orchestrator.collect_generation_results(args.run_id)
+    elif args.command == "plan":
+        from RunPlanner import RunPlanner
+        from config import MAX_WORKERS, LLM_REQUESTS_PER_MINUTE
+        planner = RunPlanner(max_workers=args.workers or MAX_WORKERS,
+                             requests_per_minute=LLM_REQUESTS_PER_MINUTE if args.rpm is None else args.rpm,
+                             distributed=args.distributed)
+        planner.print_report(planner.plan(args.collections, args.query_types))
+    elif args.command in ("export-results", "import-results"):
+        from ResultStore import ResultStore
+        if args.command == "export-results":
+            ResultStore().export(PROMPT_RESULT_DIR, args.collections)
+        else:
+            ResultStore().import_files(PROMPT_RESULT_DIR)
+    else:
+        orchestrator.run_workflow(generate_prompt_results=args.command in (None, "generate"),
+                                  clean_results=args.command in (None, "clean"),
+                                  collate_results=args.command in (None, "collate"),
+                                  collections=args.collections, query_types=args.query_types)
     end_time = time.time()
-    
-    orchestrator.logger.info(f"Total workflow time: {end_time - start_time:.2f} seconds.")
\ No newline at end of file
+
+    orchestrator.logger.info(f"Total workflow time: {end_time - start_time:.2f} seconds.")
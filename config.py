@@ -16,15 +16,20 @@ COLLECTION_INFO_DIR = DATA_DIR / "collection_info"
 OUTPUT_CSV_DIR = OUTPUT_DIR / "output_csv"
 ERROR_FILES_DIR = OUTPUT_DIR / "error_files"
 DB_ERRORS_DIR = OUTPUT_DIR / "db_errors"
+QUERY_PROFILES_DIR = OUTPUT_DIR / "query_profiles"
+CLEAN_INDEX_FILE = OUTPUT_DIR / "clean_index.json"
+RESULT_STORE_FILE = DATA_DIR / "prompt_results.sqlite"
+LLM_METRICS_FILE = LOGS_DIR / "llm_calls.jsonl"
 
 #------------------------ TRAINING DATA GENERATION ----------------------
-from dotenv import load_dotenv
-load_dotenv()
+def get_api_key():
+    """Reads API_KEY from the environment, loading the .env file only when a client needs it."""
+    from dotenv import load_dotenv
+    load_dotenv()
+    return os.getenv("API_KEY")
 
-API_KEY = (os.getenv("API_KEY"))
 EXTERNAL_MODEL="gemini-2.5-flash"
 
-QUERIES_DIR.mkdir(exist_ok=True)
 QUERY_TYPES_FILE = QUERIES_DIR / "query_types.json"
 PERMENANT_QUERY_TYPES_FILE = QUERIES_DIR / "query_types_perm.json"
 PROMPT1_FILE = QUERIES_DIR / "sql_query_generation.secrets"
@@ -32,12 +37,75 @@ PROMPT2_FILE = QUERIES_DIR / "question_generation.secrets"
 PROMPT3_FILE = QUERIES_DIR / "search_terms_generation.secrets"
 PROMPT4_FILE = QUERIES_DIR / "answer_generation.secrets"
 
+# Per-collection prompt prefixes are registered once as cached context and reused by later calls
+CONTEXT_CACHING = True
+CONTEXT_CACHE_TTL_SECONDS = 3600
+CONTEXT_CACHE_RETRY_SECONDS = 60 # Wait before registering a prefix again after a transient failure
+
+# Stream responses and cancel them once they clearly fail the expected section format
+STREAM_RESPONSES = False
+STREAM_ABORT_AFTER_LINES = 10
+
+# Per-call deadline, hedged requests and circuit breaker for LLM calls
+LLM_CALL_TIMEOUT_SECONDS = 120
+HEDGE_REQUESTS = True
+HEDGE_LATENCY_PERCENTILE = 0.95 # A duplicate request is sent once a call runs longer than this
+HEDGE_MIN_SAMPLES = 20 # Successful calls needed before the latency percentile is trusted
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_SECONDS = 60
+
+# "llm" asks the model for answers (prompt 4); "execute" renders them from the validated queries' results
+ANSWER_MODE = "llm"
+ANSWER_RESULT_LIMIT = 20 # Documents read per query when rendering answers
+
+# Ask the model for schema-constrained JSON instead of free text sections
+JSON_OUTPUT = False
+
+# Keep prompt results in the packed ResultStore instead of one text file each in PROMPT_RESULT_DIR
+RESULT_STORE = True
+RESULT_STORE_MMAP_BYTES = 256 * 1024 * 1024
+
+# Dry-run planning: used where no past results or call metrics are available
+PLAN_CHARS_PER_TOKEN = 4
+PLAN_DEFAULT_OUTPUT_TOKENS = 800 # Per call
+PLAN_DEFAULT_LATENCY_SECONDS = 15 # Per call
+
+# Only clean prompt results whose content, collection info or cleaner settings changed since the last run
+INCREMENTAL_CLEANING = True
+
 
 #----------------------------- DB CONNECTION ----------------------------
 DATABASE="NL2SQL"
 HOST="localhost"
 PORT=27017
 
+# Validate against a sampled copy of each collection instead of the full database
+SANDBOX_VALIDATION = False
+SANDBOX_DATABASE="NL2SQL_sandbox"
+SANDBOX_SAMPLE_SIZE = 1000 # Documents sampled per collection
+SANDBOX_STRATIFY_FIELDS = {} # Collection name -> field whose values are sampled proportionally
+SANDBOX_MAX_STRATA = 50
+SANDBOX_REFRESH_HOURS = 24 # Sampled collections older than this are rebuilt
+
+QUERY_CACHE_SIZE = 4096 # Compiled queries kept in memory, keyed by query text
+STATIC_VALIDATION = True # Check queries against the collection_info schema before running them
+# Reject queries on top-level fields the schema does not list; turn off for incomplete schemas
+STATIC_VALIDATION_STRICT = True
+
+# Explain every valid query and annotate the output with its plan and cost
+PROFILE_QUERIES = False
+LOW_SELECTIVITY_RATIO = 10 # Flag queries examining this many documents per document returned
+LOW_SELECTIVITY_MIN_DOCS = 1000
+
+# Distributed generation: prompt-set jobs are leased from a queue shared by all worker nodes
+JOB_QUEUE_DATABASE="NL2SQL_jobs"
+JOB_QUEUE_COLLECTION="generation_jobs"
+RATE_BUDGET_COLLECTION="llm_rate_budget"
+JOB_LEASE_SECONDS = 300
+JOB_HEARTBEAT_SECONDS = 60
+JOB_MAX_ATTEMPTS = 3
+LLM_REQUESTS_PER_MINUTE = 60 # Shared by every worker node
+
 
 #-------------------------------- OTHERS --------------------------------
 MAX_WORKERS = 3
\ No newline at end of file